@@ -0,0 +1,55 @@
+'''
+Generates synthetic Celltone programs for the benchmarks, scaled
+along one axis at a time.
+'''
+
+import random
+
+# the program that every axis is scaled from
+DEFAULTS = {
+    'parts': 4,
+    'length': 32,
+    'rules': 4,
+    'conditions': 2,
+    'anyindexed': 0.5,
+    'pauses': 0.2,
+    }
+
+def generate(parts = 4, length = 32, rules = 4, conditions = 2,
+             anyindexed = 0.5, pauses = 0.2, seed = 0):
+    '''
+    Returns the source of a program with the given number of parts,
+    each length notes long, and the given number of rules, each with
+    the given number of conditions. anyindexed is the share of note
+    references that are any-indexed, like <1>[0], rather than
+    indexed, like p0[0]. pauses is the share of notes that are
+    pauses. The same arguments always give the same program.
+    '''
+    r = random.Random(seed)
+    names = ['p%d' % i for i in range(parts)]
+
+    def note():
+        if r.random() < pauses:
+            return '_'
+        return str(r.randint(0, 24))
+
+    def reference():
+        if r.random() < anyindexed:
+            return '<%d>[%d]' % (r.randint(-1, 1), r.randint(-2, 2))
+        return '%s[%d]' % (r.choice(names), r.randint(-2, 2))
+
+    def value():
+        if r.random() < 0.5:
+            return note()
+        return reference()
+
+    lines = []
+    for i, name in enumerate(names):
+        lines.append('%s = [%s]' % (name, ', '.join(note() for _ in range(length))))
+        lines.append('%s.channel = %d' % (name, i % 16))
+    for _ in range(rules):
+        lhs = ['%s %s %s' % (reference(), r.choice(['==', '!=', '<', '>']), value())
+               for _ in range(conditions)]
+        rhs = ['%s = %s' % (reference(), value())]
+        lines.append('{%s} => {%s}' % (', '.join(lhs), ', '.join(rhs)))
+    return '\n'.join(lines) + '\n'
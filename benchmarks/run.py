@@ -0,0 +1,185 @@
+'''
+Benchmarks for the parser, the engine and the MIDI file writer.
+
+    python run.py                       # run everything
+    python run.py --save baseline.json  # store the results
+    python run.py --compare baseline.json --threshold 0.2
+
+Every benchmark reports the best time of one operation, in seconds.
+With --compare, benchmarks that got slower than the baseline by more
+than the threshold (0.2 is 20%) are flagged, and the exit status is
+1 if there were any.
+'''
+
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from celltone.model import Engine
+from celltone.parser import Parser
+from celltone.cellmidi import Writer
+from generate import generate, DEFAULTS
+import gc
+import json
+import tempfile
+import time
+
+# values that each axis is scaled to, the others keeping their
+# defaults
+AXES = [
+    ('parts', [1, 4, 16, 64]),
+    ('length', [8, 32, 256, 2048]),
+    ('rules', [1, 4, 16, 64]),
+    ('conditions', [0, 2, 4, 8]),
+    ('anyindexed', [0.0, 1.0]),
+    ('pauses', [0.0, 0.5, 0.9]),
+    ]
+
+def programs():
+    '''
+    Yields (name, source) for the default program and for every
+    value of every axis.
+    '''
+    yield 'default', generate(**DEFAULTS)
+    for axis, values in AXES:
+        for value in values:
+            if value == DEFAULTS[axis]:
+                continue
+            options = dict(DEFAULTS)
+            options[axis] = value
+            yield '%s=%s' % (axis, value), generate(**options)
+
+def measure(function, min_time = 0.5, repeat = 5):
+    '''
+    Returns the best time per call of function, calling it in
+    batches that take at least min_time seconds. The best of
+    several batches is what is left once other processes and the
+    like have been given a chance not to interfere, which is what
+    makes runs comparable.
+    '''
+    number = 1
+    while True:
+        seconds = timed(function, number)
+        if seconds >= min_time:
+            break
+        number *= 2
+    for i in range(repeat - 1):
+        seconds = min(seconds, timed(function, number))
+    return seconds / number
+
+def timed(function, number):
+    # like timeit, without garbage collections that may be due
+    # to whatever ran before
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.time()
+        for i in range(number):
+            function()
+        return time.time() - started
+    finally:
+        gc.enable()
+
+def bench_parse(code):
+    return measure(lambda: Parser().parse(code))
+
+def bench_iterate(code, engine_class):
+    # without cycle detection, so that every iteration applies rules
+    engine = engine_class(*Parser().parse(code), detect_cycles = False)
+    return measure(engine.iterate)
+
+def bench_midi_notes(code, engine_class):
+    engine = engine_class(*Parser().parse(code), detect_cycles = False)
+    parts = engine.parts.values()
+    def get_midi_notes():
+        # the engine never moves on here, so without clearing the
+        # caches of the parts only the first call would make notes
+        for part in parts:
+            part.midi_cache.clear()
+        engine.get_midi_notes()
+    return measure(get_midi_notes)
+
+def bench_writer(code):
+    '''
+    Time to encode one iteration of midi notes.
+    '''
+    parts, rules, part_order, config = Parser().parse(code)
+    midi_notes = Engine(parts, rules, part_order, config).get_midi_notes()
+    fd, filename = tempfile.mkstemp(suffix = '.mid')
+    os.close(fd)
+    writer = Writer(filename, config.get('tempo'), config.get('subdiv'))
+    try:
+        return measure(lambda: writer.render(midi_notes))
+    finally:
+        writer.write()
+        os.remove(filename)
+
+def run(engine_class, name_filter = None):
+    results = {}
+    for name, code in programs():
+        benchmarks = [
+            ('parse', lambda: bench_parse(code)),
+            ('iterate', lambda: bench_iterate(code, engine_class)),
+            ('midi_notes', lambda: bench_midi_notes(code, engine_class)),
+            ]
+        if name == 'default' or name.startswith('parts=') or name.startswith('pauses='):
+            benchmarks.append(('writer', lambda: bench_writer(code)))
+        for benchmark, function in benchmarks:
+            full_name = '%s/%s' % (benchmark, name)
+            if name_filter and name_filter not in full_name:
+                continue
+            results[full_name] = function()
+            sys.stdout.write('%-28s %12.6f\n' % (full_name, results[full_name]))
+            sys.stdout.flush()
+    return results
+
+def compare(results, baseline, threshold):
+    '''
+    Prints how results changed from baseline, and returns the
+    names of the benchmarks that got slower by more than threshold.
+    '''
+    regressions = []
+    print('')
+    print('%-28s %12s %12s %8s' % ('benchmark', 'baseline', 'now', 'change'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        change = results[name] / baseline[name] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-28s %12.6f %12.6f %+7.1f%%%s' %
+              (name, baseline[name], results[name], change * 100, flag))
+    return regressions
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Run the Celltone benchmarks')
+    parser.add_argument('--save', help = 'Write the results to a JSON file')
+    parser.add_argument('--compare', help = 'Compare the results to a JSON file saved earlier')
+    parser.add_argument('--threshold', type = float, default = 0.2,
+                        help = 'Slowdown that counts as a regression, 0.2 being 20%%')
+    parser.add_argument('--backend', choices = ['python', 'numpy'], default = 'python')
+    parser.add_argument('--filter', help = 'Only run benchmarks whose name contains <FILTER>')
+    args = parser.parse_args()
+
+    if args.backend == 'numpy':
+        from celltone.vectorized import VectorEngine as engine_class
+    else:
+        engine_class = Engine
+
+    results = run(engine_class, args.filter)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\n%d regression(s) above %d%%' % (len(regressions), args.threshold * 100))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
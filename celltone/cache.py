@@ -0,0 +1,132 @@
+# Celltone - Generative music composition using cellular automata
+# Copyright (C) 2012   andreas@jansson.me.uk
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''
+On-disk cache of parsed programs, so that running the same source
+again skips lexing and parsing altogether.
+'''
+
+import hashlib
+import os
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import celltone
+
+# part of the key of every cached program. Bump it whenever a class
+# that ends up in the pickles changes, so that old programs are not
+# loaded into objects that lack what the code now expects
+CACHE_FORMAT = 2
+
+class ProgramCache(object):
+    '''
+    Programs are stored as pickles of what Parser.parse() returns,
+    one file per program, named by a hash of the source, the
+    Celltone version and CACHE_FORMAT. When the files add up to
+    more than max_size bytes, the least recently used ones are
+    removed.
+
+    The cache is only ever an optimisation: if the directory can
+    not be read or written, programs are simply not cached.
+    '''
+
+    def __init__(self, directory, max_size = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                celltone.notice('Cannot create the program cache: %s' % e)
+
+    def filename(self, code):
+        key = hashlib.sha1('%s\0%d\0%s' % (celltone.__version__, CACHE_FORMAT,
+                                             code)).hexdigest()
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, code):
+        '''
+        Returns the cached program for code, or None.
+        '''
+        filename = self.filename(code)
+        try:
+            with open(filename, 'rb') as f:
+                program = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # left behind by something else than this version
+            self.remove(filename)
+            return None
+        # the modification time tells when the program was last used
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return program
+
+    def put(self, code, program):
+        '''
+        Stores program, if possible. Returns True if it was.
+        '''
+        # written to a temporary file first, so that other processes
+        # never read a half written program
+        temp_filename = None
+        try:
+            fd, temp_filename = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(program, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_filename, self.filename(code))
+        except Exception, e:
+            # pickling can fail too, not only the file system
+            celltone.notice('Cannot write to the program cache: %s' % e)
+            if temp_filename:
+                self.remove(temp_filename)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        files = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith('.pickle'):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, filename))
+
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, filename in sorted(files):
+            if size <= self.max_size:
+                break
+            self.remove(filename)
+            size -= file_size
+
+    def remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
@@ -15,42 +15,120 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # 
 
+from collections import deque
+import functools
 import math
+import struct
 import time
 import threading
 import celltone
-try:
-    import midi
-except ImportError:
-    celltone.notice('No midi module, midi writing will not work')
+from model import MidiNote
 try:
     import pypm
 except ImportError:
     celltone.notice('No pypm module, midi playback will not work')
+
+# time.monotonic is not available in python 2
+clock = getattr(time, 'monotonic', time.time)
             
 class Handler(object):
 
     def __init__(self, bpm, subdivision):
         self.bpm = float(bpm)
-        self.thread = None
+        self.scheduler = None
         self.subdivision = int(subdivision)
         self.time = 0
 
     def set_tempo(self, tempo):
-        self.bpm = float(tempo)
+        '''
+        Changes the tempo from the first step queued after this
+        call.
+        '''
+        self.call(self.apply_tempo, tempo)
 
     def set_subdivision(self, subdivision):
+        '''
+        Changes the subdivision from the first step queued after
+        this call.
+        '''
+        self.call(self.apply_subdivision, subdivision)
+
+    def apply_tempo(self, tempo):
+        self.bpm = float(tempo)
+
+    def apply_subdivision(self, subdivision):
         self.subdivision = int(subdivision)
 
+    def call(self, function, *args):
+        '''
+        Calls function in between steps, once the steps queued so
+        far have been played. That way the scheduler thread is the
+        only one to touch the state of a handler while it plays.
+        '''
+        if self.scheduler is None:
+            function(*args)
+        else:
+            self.scheduler.call(functools.partial(function, *args))
+
     def play(self, midi_notes):
-        self.thread = OutputThread(self, midi_notes)
-        self.thread.start()
-        return self.thread
+        '''
+        Queues midi_notes to be played straight after whatever is
+        already queued.
+        '''
+        if self.scheduler is None:
+            self.scheduler = Scheduler(self)
+            self.scheduler.start()
+        self.scheduler.add(midi_notes)
 
     def stop(self):
-        leftover_midi_notes = self.thread.midi_notes
-        self.thread.midi_notes = []
-        return leftover_midi_notes
+        '''
+        Stops after the step that is currently playing, and returns
+        the steps that were not played.
+        '''
+        if self.scheduler is None:
+            return []
+        return self.scheduler.clear()
+
+    def wait(self, timeout = None):
+        '''
+        Blocks until every queued step has started playing, or
+        until timeout seconds have passed. Returns False on
+        timeout.
+        '''
+        if self.scheduler:
+            return self.scheduler.wait(timeout)
+        return True
+
+    def join(self):
+        '''
+        Blocks until every queued step has finished playing.
+        '''
+        if self.scheduler:
+            self.scheduler.join_idle()
+
+    def close(self):
+        '''
+        Finishes playing what is queued and ends the scheduler
+        thread.
+        '''
+        if self.scheduler:
+            self.scheduler.close()
+            self.scheduler.join()
+            self.scheduler = None
+
+    def render(self, midi_notes):
+        '''
+        Like play(), but synchronous, in the calling thread.
+        '''
+        for notes in midi_notes:
+            self.play_step(notes)
+
+    def play_step(self, notes):
+        for note in notes:
+            self.noteon(note)
+        self.after_noteon()
+        for note in notes:
+            self.noteoff(note)
 
     def noteon(self, midi_note):
         raise NotImplementedError()
@@ -59,20 +137,31 @@ class Handler(object):
         raise NotImplementedError()
 
     def after_noteon(self):
-        self.time += (60.0 / self.bpm) * ((1.0 / self.subdivision) * 4)
-
-    # TODO: make this a @decorator
-    def check_midi_note(self, midi_note):
-        if midi_note.pitch < 0 or midi_note.pitch > 127:
-            celltone.warning("Bad note number %d" % midi_note.pitch)
-            return False
-        if midi_note.velocity < 0 or midi_note.velocity > 127:
-            celltone.warning("Bad velocity %d" % midi_note.velocity)
-            return False
-        if midi_note.channel < 0 or midi_note.channel > 15:
-            celltone.warning("Bad channel number %d" % midi_note.channel)
-            return False
-        return True
+        self.time += self.step_duration()
+
+    def step_duration(self):
+        return (60.0 / self.bpm) * ((1.0 / self.subdivision) * 4)
+
+    def now(self):
+        return clock()
+
+    def wait_until(self, deadline):
+        '''
+        Realtime handlers sleep until deadline, a time given by
+        now(). Others don't have to wait at all.
+        '''
+        pass
+
+class NullHandler(Handler):
+    '''
+    Discards every note. Used for timing the engine on its own.
+    '''
+
+    def noteon(self, midi_note):
+        pass
+
+    def noteoff(self, midi_note):
+        pass
 
 class Player(Handler):
 
@@ -84,92 +173,223 @@ class Player(Handler):
         self.midi_out = pypm.Output(dev)
 
     def noteon(self, midi_note):
-        if self.check_midi_note(midi_note):
-            self.midi_out.WriteShort(0x90 + midi_note.channel,
-                                     midi_note.pitch, midi_note.velocity)
+        self.midi_out.WriteShort(0x90 + midi_note.channel,
+                                 midi_note.pitch, midi_note.velocity)
 
     def noteoff(self, midi_note):
-        if self.check_midi_note(midi_note):
-            if midi_note.pitch >= 0 or midi_note.pitch <= 127:
-                self.midi_out.WriteShort(0x80 + midi_note.channel,
-                                         midi_note.pitch, 0)
+        self.midi_out.WriteShort(0x80 + midi_note.channel, midi_note.pitch, 0)
 
-    def after_noteon(self):
-        Handler.after_noteon(self)
-        seconds = (60.0 / self.bpm) * ((1.0 / self.subdivision) * 4)
-        time.sleep(seconds)
+    def wait_until(self, deadline):
+        seconds = deadline - self.now()
+        if seconds > 0:
+            time.sleep(seconds)
 
 class Writer(Handler):
+    '''
+    Writes a type 0 Standard MIDI File. Events are encoded as they
+    are played and written to the file in chunks, so memory use
+    does not grow with the length of the piece. The track length in
+    the header is patched on every flush, so if the process dies the
+    file is still readable up to the last flush, only missing the
+    end of track event.
+    '''
+
+    # bytes of events to buffer before writing them to the file
+    flush_size = 16384
 
     def __init__(self, filename, bpm, subdivision):
         Handler.__init__(self, bpm, subdivision)
 
         self.filename = filename
-        self.track = []
+        self.subres = 12
+        self.resolution = int(math.ceil(self.subres * self.subdivision / 4.0))
         self.tick = 0
         self.prev_tick = 0
-        self.subres = 12
+        self.step_ticks = self.subres
+        self.running_status = None
+        self.buffer = bytearray()
+        self.track_length = 0
+
+        self.file = open(filename, 'wb')
+        self.file.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, self.resolution))
+        self.file.write(b'MTrk')
+        self.track_length_offset = self.file.tell()
+        self.file.write(struct.pack('>I', 0))
+        self.write_tempo()
+        self.flush()
+
+    def apply_tempo(self, tempo):
+        if float(tempo) != self.bpm:
+            Handler.apply_tempo(self, tempo)
+            self.write_tempo()
+
+    def apply_subdivision(self, subdivision):
+        Handler.apply_subdivision(self, subdivision)
+        # the resolution is fixed by the header, so the length of
+        # a step changes instead
+        self.step_ticks = self.resolution * 4.0 / self.subdivision
 
     def noteon(self, note):
-        if self.check_midi_note(note):
-            on = midi.NoteOnEvent(
-                tick = self.delta_tick(), channel = note.channel,
-                data = [note.pitch, note.velocity])
-            self.track.append(on)
+        self.write_event(0x90 + note.channel, note.pitch, note.velocity)
 
     def noteoff(self, note):
-        if self.check_midi_note(note):
-            off = midi.NoteOffEvent(
-                tick = self.delta_tick(), channel = note.channel,
-                data = [note.pitch, note.velocity])
-            self.track.append(off)
+        # note on with velocity 0, to make the most of running status
+        self.write_event(0x90 + note.channel, note.pitch, 0)
 
     def after_noteon(self):
         Handler.after_noteon(self)
-        self.tick += self.subres
+        self.tick += self.step_ticks
 
     def delta_tick(self):
-        delta = self.tick - self.prev_tick
-        if delta:
-            self.prev_tick = self.tick
+        tick = int(round(self.tick))
+        delta = tick - self.prev_tick
+        self.prev_tick = tick
         return delta
 
-    def make_meta_track(self):
-        tempo_event = midi.SetTempoEvent(tick = 0)
-        tempo_event.set_bpm(self.bpm)
-        eot = midi.EndOfTrackEvent()
-        eot.tick = 0
-        return [tempo_event, eot]
+    def write_event(self, status, data1, data2):
+        self.buffer += varlen(self.delta_tick())
+        if status != self.running_status:
+            self.buffer.append(status)
+            self.running_status = status
+        self.buffer.append(data1)
+        self.buffer.append(data2)
+        if len(self.buffer) >= self.flush_size:
+            self.flush()
+
+    def write_meta(self, meta_type, data):
+        self.buffer += varlen(self.delta_tick())
+        self.buffer += bytearray([0xff, meta_type]) + varlen(len(data)) + data
+        # meta events cancel running status
+        self.running_status = None
+
+    def write_tempo(self):
+        mpqn = int(60000000 / self.bpm)
+        self.write_meta(0x51, bytearray(struct.pack('>I', mpqn)[1:]))
+
+    def flush(self):
+        self.file.write(bytes(self.buffer))
+        self.track_length += len(self.buffer)
+        self.buffer = bytearray()
+        self.file.seek(self.track_length_offset)
+        self.file.write(struct.pack('>I', self.track_length))
+        self.file.seek(0, 2)
+        self.file.flush()
 
     def write(self):
-        eot = midi.EndOfTrackEvent()
-        eot.tick = self.delta_tick()
-        self.track.append(eot)
-        meta_track = self.make_meta_track()
-        pattern = midi.Pattern(tracks = [meta_track, self.track],
-                               resolution = math.ceil(self.subres * self.subdivision / 4.0))
-        midi.write_midifile(self.filename, pattern)
+        if self.file.closed:
+            return
+        self.write_meta(0x2f, bytearray())
+        self.flush()
+        self.file.close()
 
-class OutputThread(threading.Thread):
+def varlen(value):
+    '''
+    MIDI variable length quantity.
+    '''
+    encoded = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        encoded.insert(0, (value & 0x7f) | 0x80)
+        value >>= 7
+    return encoded
 
-    def __init__(self, handler, midi_notes):
-        self.handler = handler
-        self.midi_notes = midi_notes
+class Scheduler(threading.Thread):
+    '''
+    A single thread that plays steps from a queue for as long as
+    the handler lives. Steps are played at absolute deadlines, each
+    one step duration after the previous, so the time it takes to
+    compute and queue the next iteration does not add up as drift.
+    If the queue runs dry for more than a step, the timeline starts
+    over when the next step arrives.
+
+    Besides steps, the queue holds functions that change the
+    handler, like a new tempo, which are called in turn.
+    '''
+
+    def __init__(self, handler):
         threading.Thread.__init__(self)
+        self.daemon = True
+        self.handler = handler
+        self.steps = deque()
+        self.condition = threading.Condition()
+        self.busy = False
+        self.closed = False
+        self.deadline = None
+
+    def add(self, midi_notes):
+        with self.condition:
+            self.steps.extend(midi_notes)
+            self.condition.notify_all()
+
+    def call(self, function):
+        with self.condition:
+            self.steps.append(function)
+            self.condition.notify_all()
+
+    def clear(self):
+        with self.condition:
+            leftover_midi_notes = [notes for notes in self.steps
+                                   if not callable(notes)]
+            # changes to the handler still apply to what comes next
+            self.steps = deque(step for step in self.steps if callable(step))
+            self.condition.notify_all()
+        return leftover_midi_notes
+
+    def wait(self, timeout = None):
+        if timeout is not None:
+            deadline = clock() + timeout
+        with self.condition:
+            while self.steps:
+                if timeout is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - clock()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def join_idle(self):
+        with self.condition:
+            while self.steps or self.busy:
+                self.condition.wait()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
 
     def run(self):
-        while len(self.midi_notes) > 0:
-            notes = self.midi_notes[0]
-            self.midi_notes = self.midi_notes[1:]
+        handler = self.handler
+        while True:
+            with self.condition:
+                while not self.steps and not self.closed:
+                    self.condition.wait()
+                if not self.steps:
+                    return
+                notes = self.steps.popleft()
+                self.busy = True
+                self.condition.notify_all()
+
+            if callable(notes):
+                notes()
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+                continue
+
+            now = handler.now()
+            if self.deadline is None or now - self.deadline > handler.step_duration():
+                self.deadline = now
+            handler.wait_until(self.deadline)
             for note in notes:
-                self.handler.noteon(note)
-            self.handler.after_noteon()
+                handler.noteon(note)
+            handler.after_noteon()
+            self.deadline += handler.step_duration()
+            handler.wait_until(self.deadline)
             for note in notes:
-                self.handler.noteoff(note)
-
-class MidiNote(object):
+                handler.noteoff(note)
 
-    def __init__(self, pitch, channel, velocity):
-        self.pitch = int(pitch)
-        self.channel = int(channel)
-        self.velocity = int(velocity)
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
@@ -0,0 +1,10 @@
+# lextab.py. This file automatically created by PLY (version 3.11). Don't edit!
+_tabversion   = '3.10'
+_lextokens    = set(('ANYINDEX', 'ASSIGN', 'BECOMES', 'COMMA', 'DOT', 'EQ', 'GT', 'GTE', 'ID', 'LCURLY', 'LSQUARE', 'LT', 'LTE', 'NEQ', 'NUMBER', 'OPTION', 'PAUSE', 'RCURLY', 'RSQUARE'))
+_lexreflags   = 64
+_lexliterals  = ''
+_lexstateinfo = {'INITIAL': 'inclusive'}
+_lexstatere   = {'INITIAL': [('(?P<t_NUMBER>[-+]?\\d+)|(?P<t_OPTION><[a-zA-Z][a-zA-Z0-9_]*>)|(?P<t_ANYINDEX><[-+]?\\d+>)|(?P<t_EQ>==)|(?P<t_NEQ>!=)|(?P<t_LT><)|(?P<t_LTE><=)|(?P<t_GT>>)|(?P<t_GTE>>=)|(?P<t_COMMENT>\\#.*)|(?P<t_newline>\\n)|(?P<t_ID>[a-zA-Z][a-zA-Z0-9_]*)|(?P<t_RCURLY>\\})|(?P<t_BECOMES>=>)|(?P<t_RSQUARE>\\])|(?P<t_LSQUARE>\\[)|(?P<t_DOT>\\.)|(?P<t_LCURLY>\\{)|(?P<t_ASSIGN>=)|(?P<t_PAUSE>_)|(?P<t_COMMA>,)', [None, ('t_NUMBER', 'NUMBER'), ('t_OPTION', 'OPTION'), ('t_ANYINDEX', 'ANYINDEX'), ('t_EQ', 'EQ'), ('t_NEQ', 'NEQ'), ('t_LT', 'LT'), ('t_LTE', 'LTE'), ('t_GT', 'GT'), ('t_GTE', 'GTE'), ('t_COMMENT', 'COMMENT'), ('t_newline', 'newline'), (None, 'ID'), (None, 'RCURLY'), (None, 'BECOMES'), (None, 'RSQUARE'), (None, 'LSQUARE'), (None, 'DOT'), (None, 'LCURLY'), (None, 'ASSIGN'), (None, 'PAUSE'), (None, 'COMMA')])]}
+_lexstateignore = {'INITIAL': ' \t'}
+_lexstateerrorf = {'INITIAL': 't_error'}
+_lexstateeoff = {}
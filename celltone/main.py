@@ -21,21 +21,22 @@ import parser
 import sys
 import signal
 import time
+import math
 import os
-import stat
 import os.path
 import cellmidi
 
+__version__ = '0.2'
+
 celltone_home = os.path.expanduser('~/.celltone')
 
 class Celltone(object):
 
     def __init__(self, code, verbosity = 0, source_file = None, dynamic_update = False,
                  output_file = None, length = None, die_on_error = True,
-                 catch_sigint = True):
-
-        if not os.path.exists(celltone_home):
-            os.mkdir(celltone_home)
+                 catch_sigint = True, backend = 'python', lookahead = 0,
+                 step_update = False, use_cache = True, profile = False,
+                 benchmark = False, jobs = None):
 
         if catch_sigint:
             def signal_exit(*args):
@@ -49,28 +50,54 @@ class Celltone(object):
             self.verbose = Verbose(verbosity)
         else:
             self.verbose = None
-
-        if dynamic_update:
-            self.source_file = source_file
-            self.source_mtime = self.get_source_mtime()
+        self.watcher = None
         self.dynamic_update = dynamic_update
+        # apply updates at the next step rather than the next iteration
+        self.step_update = step_update
         self.output_file = output_file
         self.length = float(length) if length else 0
         self.leftover_midi_notes = None
         self.is_playing = False
 
+        # kept for dynamic updates, since it remembers parts it has
+        # already parsed
+        self.parser = parser.Parser()
         if code:
             try:
-                p = parser.Parser()
-                parts, rules, part_order, config = p.parse(code)
+                parts, rules, part_order, config = self.parse(code, use_cache)
             except parser.ParseError as e:
                 self.error(str(e))
         else:
             self.error('Error: Empty input')
-        self.engine = model.Engine(parts, rules, part_order, config)
+        if backend == 'numpy':
+            from vectorized import VectorEngine as Engine
+        elif backend == 'parallel':
+            from parallel import ParallelEngine
+            Engine = lambda *args: ParallelEngine(*args, jobs = jobs)
+        else:
+            Engine = model.Engine
+        try:
+            self.engine = Engine(parts, rules, part_order, config)
+        except Exception as e:
+            self.error('Failed to start engine: ' + str(e))
+        self.warn_program()
+        # the rule log is only needed for printing applied rules
+        self.engine.logger.enabled = verbosity >= 2
+        self.engine.profiler.enabled = profile
+        # like SIGINT, only caught when running as the program, as
+        # signal handlers can only be set from the main thread.
+        # others can call print_profile() themselves
+        if profile and catch_sigint and hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda *args: self.print_profile())
+        self.engine_process = None
+        if lookahead:
+            from worker import EngineProcess
+            self.engine_process = EngineProcess(code, lookahead, backend, verbosity)
         tempo = config.get('tempo')
         subdiv = config.get('subdiv')
-        if self.output_file:
+        if benchmark:
+            self.midi_handler = cellmidi.NullHandler(tempo, subdiv)
+        elif self.output_file:
             self.midi_handler = cellmidi.Writer(output_file, tempo, subdiv)
         else:
             try:
@@ -78,6 +105,34 @@ class Celltone(object):
             except Exception, e:
                 self.error('Failed to start MIDI: ' + str(e))
 
+        if dynamic_update:
+            from watcher import Watcher
+            self.watcher = Watcher(source_file, code)
+            self.watcher.start()
+
+    def parse(self, code, use_cache = True):
+        '''
+        Parses code, or loads it from the program cache in
+        celltone_home if it has been parsed before.
+        '''
+        if not use_cache:
+            return self.parser.parse(code)
+        from cache import ProgramCache
+        program_cache = ProgramCache(os.path.join(celltone_home, 'programs'))
+        program = program_cache.get(code)
+        if program is None:
+            program = self.parser.parse(code)
+            program_cache.put(code, program)
+        return program
+
+    def warn_program(self):
+        for text in model.rule_warnings(self.engine.rules, self.engine.part_order,
+                                        self.engine.parts):
+            warning(text)
+        # notes are checked here rather than every time they play
+        for text in model.midi_warnings(self.engine.parts, self.engine.compiled_rules):
+            warning(text)
+
     def error(self, text):
         if self.die_on_error:
             die(text)
@@ -86,6 +141,15 @@ class Celltone(object):
 
     def exit(self, signal = None, frame = None):
         self.stop()
+        # the watcher thread must not outlive the interpreter
+        if self.watcher:
+            self.watcher.close()
+        self.midi_handler.close()
+        self.engine.close()
+        if self.engine_process:
+            self.engine_process.close()
+        if self.engine.profiler.enabled:
+            self.print_profile()
 
         if self.output_file:
             self.midi_handler.write()
@@ -95,20 +159,14 @@ class Celltone(object):
             def write(self, _): pass
         sys.stderr = Devnull()
 
-    def get_source_mtime(self):
-        st = os.stat(self.source_file)
-        return st[stat.ST_MTIME]
-
-    def source_file_changed(self):
-        return self.source_mtime != self.get_source_mtime()
-
     def update(self):
-        if self.source_file_changed():
-            self.source_mtime = self.get_source_mtime()
-            code = ''
-            with open(self.source_file) as f:
-                code = ''.join(f.readlines())
-            self.update_code(code)
+        '''
+        Applies the latest version of the source file, if the
+        watcher has parsed one since last time.
+        '''
+        pending = self.watcher.take()
+        if pending:
+            self.apply_update(*pending)
 
     def update_code(self, code):
         '''
@@ -118,22 +176,36 @@ class Celltone(object):
         if not code:
             warning('File is empty')
             return
+        started = time.time()
         try:
-            p = parser.Parser()
-            parts, rules, part_order, config = p.parse(code)
+            program = self.parser.parse(code)
         except parser.ParseError as e:
             warning(str(e))
             return
+        self.apply_update(code, program, started)
 
-        if config.get('partorder'):
-            part_order = config.get('partorder')
-
-        self.engine.update_parts(parts)
-        self.engine.update_rules(rules)
-        self.engine.update_part_order(part_order)
-        self.engine.update_config(config)
-        self.midi_handler.set_tempo(config.get('tempo'))
-        self.midi_handler.set_subdivision(config.get('subdiv'))
+    def apply_update(self, code, program, started):
+        '''
+        Applies a parsed program. started is the time the update
+        began, for reporting latency.
+        '''
+        parts, rules, part_order, config = program
+        if self.engine_process:
+            self.engine_process.update_code(code)
+            changes = ['engine process']
+        else:
+            changes = self.engine.update(parts, rules, part_order, config)
+            if changes:
+                self.warn_program()
+        if config.get('tempo') != self.midi_handler.bpm:
+            self.midi_handler.set_tempo(config.get('tempo'))
+            changes.append('tempo')
+        if config.get('subdiv') != self.midi_handler.subdivision:
+            self.midi_handler.set_subdivision(config.get('subdiv'))
+            changes.append('subdiv')
+
+        if self.verbose:
+            self.verbose.print_reload(changes, time.time() - started)
 
     def loop(self, initial_midi_notes = None):
         '''
@@ -146,11 +218,16 @@ class Celltone(object):
                 if self.leftover_midi_notes:
                     midi_notes = self.leftover_midi_notes
                     self.leftover_midi_notes = None
+                elif self.engine_process:
+                    midi_notes, text = self.engine_process.next()
+                    if text:
+                        sys.stdout.write(text)
                 else:
                     midi_notes = self.engine.get_midi_notes()
 
-                if self.verbose:
-                    self.verbose.print_log(model.logger.items)
+                if self.verbose and not self.engine_process:
+                    self.verbose.print_log(self.engine.logger.items,
+                                           self.engine.logger.evicted)
                     self.verbose.print_parts(self.engine.parts, self.engine.iteration_length)
 
                 self.midi_handler.play(midi_notes)
@@ -161,20 +238,105 @@ class Celltone(object):
                 if self.dynamic_update:
                     self.update()
 
-                model.logger.clear()
-                self.engine.iterate()
-        
-                # for some reason, this creates a tiny delay,
-                # making it unusable. for now, CTRL-C will take
-                # some time to kick in.
-                # while self.midi_handler.thread.is_alive():
-                #     self.midi_handler.thread.join(1)
-                self.midi_handler.thread.join()
+                if not self.engine_process:
+                    self.engine.logger.clear()
+                    cycle = self.engine.cycle
+                    self.engine.iterate()
+                    if self.verbose and self.engine.cycle and not cycle:
+                        self.verbose.print_cycle(*self.engine.cycle)
+
+                # the next iteration is queued as soon as the last
+                # step of this one has started, so that it follows
+                # on without a gap
+                self.wait()
             else:
                 # poll for another thread to call play()
                 time.sleep(0.5)
         self.exit()
 
+    def wait(self):
+        '''
+        Waits for the last queued step to start playing. With
+        step_update, an update that comes in meanwhile cuts the
+        iteration short: the steps that have not been played are
+        dropped, and the parts are moved back to the first of them.
+        '''
+        if not (self.dynamic_update and self.step_update):
+            self.midi_handler.wait()
+            return
+        while not self.midi_handler.wait(0.01):
+            if self.watcher.pending:
+                unplayed = self.midi_handler.stop()
+                self.engine.rewind(len(unplayed))
+                self.update()
+                return
+
+    def render(self, length = None, iterations = None):
+        '''
+        Renders the piece to the output file as fast as possible,
+        without playback threads or verbose output. Stops after
+        length seconds or the given number of iterations, at the
+        end of an iteration.
+        '''
+        if not self.output_file:
+            self.error('Error: Rendering requires an output file')
+        length = float(length) if length else self.length
+        if not length and not iterations:
+            self.error('Error: Rendering requires a length or a number of iterations')
+        if not len(self.engine.parts):
+            self.error('Error: No parts to play')
+
+        self.engine.logger.enabled = False
+        rendered = 0
+        while True:
+            self.midi_handler.render(self.engine.get_midi_notes())
+            rendered += 1
+            if iterations and rendered >= iterations:
+                break
+            if length and self.midi_handler.time >= length:
+                break
+            self.engine.iterate()
+
+        self.midi_handler.write()
+        self.engine.close()
+        if self.engine.profiler.enabled:
+            self.print_profile()
+
+    def benchmark(self, iterations = 1000):
+        '''
+        Runs the given number of iterations as fast as possible,
+        timing each, and returns a Benchmark. Each iteration
+        includes making the midi notes and handing them to the midi
+        handler, which is a NullHandler when benchmarking.
+        '''
+        if not len(self.engine.parts):
+            self.error('Error: No parts to play')
+
+        self.engine.logger.enabled = False
+        benchmark = Benchmark(self.engine.iteration_length,
+                              self.midi_handler.step_duration())
+        for i in range(iterations):
+            evaluated = self.engine.evaluated
+            started = time.time()
+            self.midi_handler.render(self.engine.get_midi_notes())
+            notes_done = time.time()
+            self.engine.iterate()
+            benchmark.add(time.time() - started, notes_done - started,
+                          self.engine.evaluated - evaluated)
+        benchmark.cycle = self.engine.cycle
+        self.engine.close()
+
+        if self.engine.profiler.enabled:
+            self.print_profile()
+        return benchmark
+
+    def print_profile(self):
+        '''
+        Prints how much time each rule has taken so far, when
+        profiling. Also done on exit, and on SIGUSR1.
+        '''
+        sys.stderr.write(self.engine.profiler.report())
+
     def play(self):
         if not len(self.engine.parts):
             self.error('Error: No parts to play')
@@ -203,8 +365,34 @@ def main():
     parser = argparse.ArgumentParser(description = 'Process Celltone code')
     parser.add_argument('--update', '-u', action = 'store_true',
                         help = 'Allow for dynamic updating of source file during runtime')
+    parser.add_argument('--step-update', action = 'store_true',
+                        help = 'With --update, apply changes from the next step instead '
+                        'of the next iteration')
     parser.add_argument('--file', '-f', help = 'Output to MIDI file instead of the MIDI device')
     parser.add_argument('--length', '-l', help = 'Stop after <LENGTH> seconds')
+    parser.add_argument('--render', '-r', action = 'store_true',
+                        help = 'Render to the --file MIDI file as fast as possible, then exit')
+    parser.add_argument('--iterations', '-n', type = int,
+                        help = 'With --render, stop after <ITERATIONS> iterations. '
+                        'With --bench, run <ITERATIONS> iterations (default 1000)')
+    parser.add_argument('--bench', action = 'store_true',
+                        help = 'Run the program as fast as possible without MIDI output, '
+                        'and report whether it keeps up in real time')
+    parser.add_argument('--backend', '-b', choices = ['python', 'numpy', 'parallel'],
+                        default = 'python',
+                        help = 'Engine backend. numpy evaluates rules for all beats at once, '
+                        'parallel evaluates them on all cores')
+    parser.add_argument('--jobs', '-j', type = int,
+                        help = 'Number of processes for the parallel backend '
+                        '(default: one per core)')
+    parser.add_argument('--profile', '-p', action = 'store_true',
+                        help = 'Time each rule, and print a report on exit or on SIGUSR1')
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'Always parse the source, instead of using programs '
+                        'cached in ~/.celltone')
+    parser.add_argument('--lookahead', type = int, default = 0,
+                        help = 'Run the engine in a separate process, computing up to '
+                        '<LOOKAHEAD> iterations ahead of playback')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-v', action = 'store_true', help = 'verbose')
     group.add_argument('-vv', action = 'store_true', help = 'more verbose')
@@ -233,11 +421,107 @@ def main():
     except KeyboardInterrupt:
         sys.exit(0)
 
-    ct = Celltone(code, verbosity, args.filename, args.update, args.file, args.length)
-    ct.start()
+    if args.profile and args.lookahead:
+        die('Error: --profile cannot be used with --lookahead')
+
+    if args.backend == 'parallel' and args.lookahead:
+        die('Error: --backend parallel cannot be used with --lookahead')
+
+    if args.step_update:
+        if not args.update:
+            die('Error: --step-update requires --update')
+        if args.lookahead:
+            die('Error: --step-update cannot be used with --lookahead')
+
+    if args.bench:
+        if args.update or args.render or args.file or args.lookahead:
+            die('Error: --bench cannot be used with --update, --render, --file '
+                'or --lookahead')
+
+    if args.render:
+        if not args.file:
+            die('Error: --render requires --file')
+        if not args.length and not args.iterations:
+            die('Error: --render requires --length or --iterations')
+
+    ct = Celltone(code, verbosity, args.filename, args.update, args.file, args.length,
+                  backend = args.backend, lookahead = args.lookahead,
+                  step_update = args.step_update, use_cache = not args.no_cache,
+                  profile = args.profile, benchmark = args.bench, jobs = args.jobs)
+    if args.bench:
+        sys.stdout.write(ct.benchmark(args.iterations or 1000).report())
+    elif args.render:
+        ct.render(args.length, args.iterations)
+    else:
+        ct.start()
     sys.exit(0)
 
 
+class Benchmark(object):
+    '''
+    Iteration times from Celltone.benchmark(), and how they compare
+    to real time. During playback, an iteration is computed while
+    the previous one plays, so it has to take less time than an
+    iteration lasts. The midi notes of the next iteration are only
+    made once the last step of the previous one has started though,
+    so that has to take less than a step.
+    '''
+
+    def __init__(self, iteration_length, step_duration):
+        self.iteration_length = iteration_length
+        self.step_duration = step_duration
+        self.times = []
+        self.notes_times = []
+        self.evaluations = 0
+        self.cycle = None
+
+    def add(self, seconds, notes_seconds, evaluations):
+        self.times.append(seconds)
+        self.notes_times.append(notes_seconds)
+        self.evaluations += evaluations
+
+    def keeps_up(self):
+        return percentile(self.times, 99) < self.iteration_duration() and \
+            percentile(self.notes_times, 99) < self.step_duration
+
+    def iteration_duration(self):
+        return self.iteration_length * self.step_duration
+
+    def report(self):
+        total = sum(self.times)
+        iteration_duration = self.iteration_duration()
+        p99 = percentile(self.times, 99)
+        notes_p99 = percentile(self.notes_times, 99)
+        lines = [
+            'Benchmark: %d iterations of %d steps in %.3f s' %
+            (len(self.times), self.iteration_length, total),
+            '  %.1f iterations/s, %.0f rule evaluations/s' %
+            (len(self.times) / total, self.evaluations / total),
+            '  iteration: p50 %.3f ms, p99 %.3f ms, budget %.3f ms (%.1f%% used)' %
+            (percentile(self.times, 50) * 1000, p99 * 1000,
+             iteration_duration * 1000, 100 * p99 / iteration_duration),
+            '  midi notes: p50 %.3f ms, p99 %.3f ms, budget %.3f ms (%.1f%% used)' %
+            (percentile(self.notes_times, 50) * 1000, notes_p99 * 1000,
+             self.step_duration * 1000, 100 * notes_p99 / self.step_duration),
+            ]
+        if self.cycle:
+            start, period = self.cycle
+            lines.append('  cycle of %d iterations from iteration %d, replayed '
+                         'without evaluating rules' % (period, start))
+        if self.keeps_up():
+            lines.append('Keeps up in real time')
+        else:
+            lines.append('Does NOT keep up in real time')
+        return '\n'.join(lines) + '\n'
+
+def percentile(values, p):
+    '''
+    Nearest rank percentile.
+    '''
+    values = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank - 1, 0)]
+
 def die(string, return_code = 1):
     sys.stderr.write(string + '\n')
     sys.exit(return_code)
@@ -17,30 +17,107 @@
 
 # TODO: profiling/optimisation
 
-from copy import copy, deepcopy
+from array import array
+from collections import deque
+from copy import copy
+from operator import eq, ne, lt, le, gt, ge
+import itertools
 import threading
+import time
 
 PAUSE = '_'
 
 class Logger(object):
+    '''
+    Log of the rules applied during an iteration, used for
+    verbose output. Every engine has its own. Nothing is recorded
+    unless the logger is enabled, and at most max_items entries
+    are kept, the oldest being evicted first.
+    '''
 
-    def __init__(self):
-        self.items = []
+    def __init__(self, max_items = 1000):
+        self.enabled = False
+        self.items = deque(maxlen = max_items)
+        self.evicted = 0
 
     def add(self, log_item):
+        if len(self.items) == self.items.maxlen:
+            self.evicted += 1
         self.items.append(log_item)
 
     def clear(self):
-        self.items = []
+        self.items.clear()
+        self.evicted = 0
+
+class Profiler(object):
+    '''
+    Counts and times the evaluation of each rule, summed over all
+    pivot parts and iterations. Rules are told apart by their
+    source, so the numbers carry over dynamic updates. Nothing is
+    recorded unless the profiler is enabled.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.clear()
+
+    def clear(self):
+        self.stats = {}
+        self.iterations = 0
+
+    def add(self, rule, evaluated, matched, blocked, seconds):
+        '''
+        evaluated is the number of beats the conditions were
+        checked for, matched the number of those where they all
+        held, and blocked the number of matches that could not be
+        applied since a note had already been altered.
+        '''
+        key = str(rule)
+        if key not in self.stats:
+            self.stats[key] = RuleStats()
+        stats = self.stats[key]
+        stats.evaluated += evaluated
+        stats.matched += matched
+        stats.blocked += blocked
+        stats.seconds += seconds
+
+    def report(self):
+        '''
+        Returns a table of the rules, most time consuming first.
+        '''
+        total = sum(stats.seconds for stats in self.stats.values())
+        lines = ['Rule profile: %d iterations, %.3f s in rules' %
+                 (self.iterations, total),
+                 '%9s %6s %10s %10s %10s %10s  %s' %
+                 ('seconds', '%', 'evaluated', 'matched', 'blocked', 'fired', 'rule')]
+        for key, stats in sorted(self.stats.items(), key = lambda item: -item[1].seconds):
+            percent = 100 * stats.seconds / total if total else 0
+            lines.append('%9.3f %6.1f %10d %10d %10d %10d  %s' %
+                         (stats.seconds, percent, stats.evaluated, stats.matched,
+                          stats.blocked, stats.matched - stats.blocked, key))
+        return '\n'.join(lines) + '\n'
+
+class RuleStats(object):
+
+    def __init__(self):
+        self.evaluated = 0
+        self.matched = 0
+        self.blocked = 0
+        self.seconds = 0.0
 
 class RuleLog(object):
-    def __init__(self, rule, pivot, beat_before, beat_after):
+    '''
+    reads is a list of (part, index) tuples for the notes read by
+    the conditions, and diffs a list of (part, index, old note,
+    new note) tuples for the notes written by the modifiers.
+    Indices are absolute positions in the parts.
+    '''
+
+    def __init__(self, rule, pivot, reads, diffs):
         self.rule = rule
         self.pivot = pivot
-        self.beat_before = beat_before
-        self.beat_after = beat_after
-
-logger = Logger()
+        self.reads = reads
+        self.diffs = diffs
 
 class Config(object):
 
@@ -75,13 +152,124 @@ class Config(object):
     def get(self, name):
         return self.options[name]
 
+# notes are stored as signed short integers, with pauses as the
+# smallest of them, so that pauses compare less than every note
+PAUSE_CODE = -32768
+MIN_NOTE = -32767
+MAX_NOTE = 32767
+
+def encode_note(note):
+    '''
+    Returns the integer a note is stored as.
+    '''
+    if note == PAUSE:
+        return PAUSE_CODE
+    if note < MIN_NOTE or note > MAX_NOTE:
+        raise Exception('Notes must be between %d and %d' % (MIN_NOTE, MAX_NOTE))
+    return note
+
+def decode_note(code):
+    if code == PAUSE_CODE:
+        return PAUSE
+    return code
+
+class MidiNote(object):
+
+    __slots__ = ('pitch', 'channel', 'velocity')
+
+    def __init__(self, pitch, channel, velocity):
+        self.pitch = int(pitch)
+        self.channel = int(channel)
+        self.velocity = int(velocity)
+
+def midi_note_problem(pitch, channel, velocity):
+    '''
+    Returns what is wrong with a MIDI note, or None if it can be
+    played.
+    '''
+    if pitch < 0 or pitch > 127:
+        return 'Bad note number %d' % pitch
+    if velocity < 0 or velocity > 127:
+        return 'Bad velocity %d' % velocity
+    if channel < 0 or channel > 15:
+        return 'Bad channel number %d' % channel
+    return None
+
+class NoteList(object):
+    '''
+    List-like view of the notes of a part, as they are written
+    (buffer) or as they were before the iteration (read_buffer).
+    Notes are decoded on the way out, so pauses show up as PAUSE.
+    '''
+
+    __slots__ = ('part', 'attribute')
+
+    def __init__(self, part, attribute):
+        self.part = part
+        self.attribute = attribute
+
+    def __len__(self):
+        return len(self.part.buffer)
+
+    def __getitem__(self, index):
+        buffer = getattr(self.part, self.attribute)
+        if isinstance(index, slice):
+            return map(decode_note, buffer[index])
+        return decode_note(buffer[index])
+
+    def __setitem__(self, index, note):
+        buffer = getattr(self.part, self.attribute)
+        if isinstance(index, slice):
+            buffer[index] = array('h', map(encode_note, note))
+        else:
+            buffer[index] = encode_note(note)
+        # the part can no longer tell what changed
+        self.part.changed = None
+
+    def __iter__(self):
+        return itertools.imap(decode_note, getattr(self.part, self.attribute))
+
+    def __eq__(self, other):
+        if isinstance(other, NoteList):
+            other = list(other)
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
 class Part(object):
+    '''
+    The notes of a part are kept in two arrays of integers, see
+    encode_note(). buffer holds the notes as they are written by
+    the rules, and read_buffer the notes as they were before the
+    iteration. Rather than copying one into the other, they are
+    swapped every iteration, see create_notes_copy().
+    '''
+
+    __slots__ = ('name', 'buffer', 'read_buffer', 'original_notes', 'positions',
+                 'changed', 'properties', 'pointer', 'altered', 'unaltered',
+                 'ring', 'ring_index', 'midi_offset', 'midi_table', 'midi_cache')
+
+    # number of windows of notes that midi_events() remembers the
+    # events of
+    midi_cache_size = 8
+
+    prop_bounds = {
+        'channel': (0, 127),
+        'velocity': (0, 127),
+        'octava': (0, 10),
+        'transpose': (-127, 127),
+        }
 
     def __init__(self, name, notes):
         self.name = name
-        self.notes = notes
         self.original_notes = copy(notes)
-        self.create_notes_copy()
+        self.notes = notes
 
         # defaults
         self.properties = {
@@ -90,16 +278,32 @@ class Part(object):
             'octava' : 4,
             'transpose': 0,
             }
-        self.prop_bounds = {
-            'channel': (0, 127),
-            'velocity': (0, 127),
-            'octava': (0, 10),
-            'transpose': (-127, 127),
-            }
+        self.refresh_midi()
         self.pointer = 0
-        self.altered = None
-        self.reset_altered()
-        self.next_part = self.prev_part = None
+        # until link_parts() is called, a part is a ring of its own
+        self.ring = (self,)
+        self.ring_index = 0
+
+    @property
+    def notes(self):
+        return NoteList(self, 'buffer')
+
+    @notes.setter
+    def notes(self, notes):
+        self.buffer = array('h', map(encode_note, notes))
+        self.read_buffer = array('h', self.buffer)
+        # indices of each value in read_buffer, see positions_of()
+        self.positions = None
+        # indices of the notes that set_note_at() has changed since
+        # the last copy, or None if that is not known, as when the
+        # notes are replaced like here
+        self.changed = None
+        self.unaltered = bytearray(len(self.buffer))
+        self.altered = bytearray(self.unaltered)
+
+    @property
+    def notes_copy(self):
+        return NoteList(self, 'read_buffer')
 
     def set_property(self, name, value):
         if name not in self.properties:
@@ -110,61 +314,206 @@ class Part(object):
         if value > maximum:
             raise Exception('%s must be <= %d' % (name, maximum))
         self.properties[name] = value
+        self.refresh_midi()
 
     def get_note_at(self, index):
-        return self.notes[index % len(self.notes)]
+        return decode_note(self.buffer[index % len(self.buffer)])
 
     def get_note_copy_at(self, index):
-        return self.notes_copy[index % len(self.notes)]
+        return decode_note(self.read_buffer[index % len(self.buffer)])
 
     def set_note_at(self, index, note):
-        self.notes[index % len(self.notes)] = note
-        self.altered[index % len(self.notes)] = True
+        self.set_code_at(index, encode_note(note))
+
+    def set_code_at(self, index, code):
+        '''
+        Like set_note_at(), for a note that is already encoded.
+        '''
+        index = index % len(self.buffer)
+        if self.buffer[index] != code:
+            self.buffer[index] = code
+            if self.changed is not None:
+                self.changed.add(index)
+        self.altered[index] = 1
 
     def get_altered_at(self, index):
-        return self.altered[index % len(self.notes)]
+        return bool(self.altered[index % len(self.buffer)])
 
     def reset_altered(self):
-        self.altered = [False] * len(self.notes)
+        self.altered[:] = self.unaltered
 
     def get_midi_note_at(self, index):
-        from cellmidi import MidiNote
-        note = self.notes[index % len(self.notes)]
-        if note == PAUSE:
-            return None
-        note = note + self.properties['transpose'] + 12 * self.properties['octava']
-        return MidiNote(note, self.properties['channel'], self.properties['velocity'])
+        return self.midi_note(self.buffer[index % len(self.buffer)])
+
+    def refresh_midi(self):
+        '''
+        Called whenever the properties change, which the MIDI notes
+        follow from.
+        '''
+        self.midi_offset = self.properties['transpose'] + 12 * self.properties['octava']
+        # encoded note -> MidiNote, see midi_note()
+        self.midi_table = {PAUSE_CODE: None}
+        # (pointer, length) -> (notes, events), see midi_events()
+        self.midi_cache = {}
+
+    def midi_note(self, code):
+        '''
+        Returns the MidiNote that an encoded note plays, or None
+        for pauses and notes that can not be played, which are
+        warned about when the program is loaded, see
+        midi_warnings(). There is only one MidiNote for each note,
+        shared by every step it plays at.
+        '''
+        try:
+            return self.midi_table[code]
+        except KeyError:
+            pass
+        pitch = code + self.midi_offset
+        channel = self.properties['channel']
+        velocity = self.properties['velocity']
+        midi_note = None
+        if midi_note_problem(pitch, channel, velocity) is None:
+            midi_note = MidiNote(pitch, channel, velocity)
+        self.midi_table[code] = midi_note
+        return midi_note
+
+    def midi_events(self, length):
+        '''
+        Returns (step, MidiNote) tuples for the notes played in the
+        length steps from the pointer. The events of the last few
+        windows are remembered, and reused for as long as the notes
+        in the window stay the same.
+        '''
+        buffer = self.buffer
+        size = len(buffer)
+        start = self.pointer
+        if length >= size:
+            notes = buffer[:]
+        elif start + length <= size:
+            notes = buffer[start:start + length]
+        else:
+            notes = buffer[start:] + buffer[:start + length - size]
+
+        key = (start, length)
+        cached = self.midi_cache.get(key)
+        if cached is not None and cached[0] == notes:
+            return cached[1]
+
+        if length > size:
+            notes_played = [buffer[(start + i) % size] for i in xrange(length)]
+        else:
+            notes_played = notes
+        midi_note = self.midi_note
+        events = []
+        for i, code in enumerate(notes_played):
+            note = midi_note(code)
+            if note is not None:
+                events.append((i, note))
+
+        if len(self.midi_cache) >= self.midi_cache_size:
+            self.midi_cache.clear()
+        self.midi_cache[key] = (notes, events)
+        return events
 
     def create_notes_copy(self):
         '''
         Rules should depend on the state of the part before
-        the iteration, hence we copy the notes and use them
-        in the conditions and modifiers.
+        the iteration, so conditions and modifiers read from
+        read_buffer while the notes are written to buffer.
+
+        The two are swapped, and the notes that set_note_at() has
+        changed since the last copy are written back to the new
+        buffer, which is otherwise up to date already.
+        '''
+        changed = self.changed
+        if changed is None:
+            self.positions = None
+            self.read_buffer[:] = self.buffer
+            return
+
+        if self.positions is not None:
+            for index in changed:
+                self.positions[self.read_buffer[index]].discard(index)
+                self.positions.setdefault(self.buffer[index], set()).add(index)
+        self.buffer, self.read_buffer = self.read_buffer, self.buffer
+        buffer = self.buffer
+        read_buffer = self.read_buffer
+        for index in changed:
+            buffer[index] = read_buffer[index]
+
+    def positions_of(self, code):
+        '''
+        Returns the indices where the encoded note is found in
+        read_buffer.
+        '''
+        if self.positions is None:
+            self.positions = {}
+            for index, note in enumerate(self.read_buffer):
+                self.positions.setdefault(note, set()).add(index)
+        return self.positions.get(code, ())
+
+    def reset_positions(self):
+        '''
+        Called when the notes are changed without set_note_at().
         '''
-        self.notes_copy = copy(self.notes)
+        self.positions = None
+
+    def get_state(self):
+        return self.buffer.tostring(), self.pointer
+
+    def set_state(self, state):
+        notes, self.pointer = state
+        self.buffer = array('h')
+        self.buffer.fromstring(notes)
+        self.changed = None
 
-    # TODO: make this O(1)
     def other_part_at(self, index):
         '''
-        Naive pointer implementation.
+        Returns the part index steps away in the ring set up by
+        link_parts(), wrapping around at either end.
         '''
-        if index == 0:
-            return self
-        if index > 0:
-            return self.next_part.other_part_at(index - 1)
-        if index < 0:
-            return self.prev_part.other_part_at(index + 1)
+        return self.ring[(self.ring_index + index) % len(self.ring)]
+
+    @property
+    def next_part(self):
+        return self.other_part_at(1)
+
+    @property
+    def prev_part(self):
+        return self.other_part_at(-1)
 
     def __str__(self):
         return '%s = [%s]' % (self.name, ', '.join(map(str, self.notes)))
 
+    def __getstate__(self):
+        # the read buffer, altered flags and positions follow from
+        # the notes, and changed only matters to a running engine,
+        # so there is no need to pickle them
+        return dict(name = self.name, notes = list(self.notes),
+                    original_notes = self.original_notes,
+                    properties = self.properties, pointer = self.pointer,
+                    ring = self.ring, ring_index = self.ring_index)
+
+    def __setstate__(self, state):
+        self.notes = state.pop('notes')
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+        self.refresh_midi()
+
 class Clause(object):
     '''
     A clause represents the state of a condition or a modifier
     at one particular beat, on one pivot part. In a matrix, this
     would be a cell.
+
+    The beat is an offset from the part pointers, see
+    beat_index().
     '''
 
+    __slots__ = ('subject', 'object', 'beat', 'pivot', 'subject_indexed',
+                 'subject_part', 'real_subject_index', 'subject_note',
+                 'object_indexed', 'real_object_index', 'object_part', 'object_note')
+
     def __init__(self, subject, object, beat, pivot):
         self.subject = subject
         self.object = object
@@ -176,7 +525,7 @@ class Clause(object):
         else: # AnyIndexed
             self.subject_indexed = self.subject.bind(pivot)
         self.subject_part = self.subject_indexed.part
-        current_index = beat[self.subject_part.name].index
+        current_index = beat_index(beat, self.subject_part)
         self.real_subject_index = self.subject_indexed.index + current_index
         self.subject_note = self.subject_part.get_note_copy_at(self.real_subject_index)
 
@@ -186,13 +535,24 @@ class Clause(object):
                 self.object_indexed = self.object
             else:
                 self.object_indexed = self.object.bind(pivot)
-            current_object_index = beat[self.object_indexed.part.name].index
+            current_object_index = beat_index(beat, self.object_indexed.part)
             self.real_object_index = self.object_indexed.index + current_object_index
             self.object_part = self.object_indexed.part
             self.object_note = self.object_part.get_note_copy_at(self.real_object_index)
         else:
             self.object_note = self.object
 
+def beat_index(beat, part):
+    '''
+    The index of part at beat. Beats are offsets from the start
+    of the iteration, so this is just the part pointer plus the
+    offset. A dict from part names to Indexed, as returned by
+    Engine.beat(), is also accepted.
+    '''
+    if isinstance(beat, dict):
+        return beat[part.name].index
+    return part.pointer + beat
+
 class Condition(object):
 
     def __init__(self, subject, comparator, object):
@@ -233,22 +593,36 @@ class Rule(object):
         self.lhs = lhs
         self.rhs = rhs
 
-    def apply(self, beat, pivot):
+    def apply(self, beat, pivot, logger = None):
         for condition in self.lhs:
             if not condition.matches(beat, pivot):
                 return
 
-        # TODO: see if faster to run can_alter before matching
         for modifier in self.rhs:
             if not modifier.can_alter(beat, pivot):
                 return
 
-        beat_before = deepcopy(beat)
+        if logger and logger.enabled:
+            logger.add(self.log(beat, pivot))
 
         for modifier in self.rhs:
             modifier.alter(beat, pivot)
 
-        logger.add(RuleLog(self, pivot, beat_before, deepcopy(beat)))
+    def log(self, beat, pivot):
+        reads = []
+        for condition in self.lhs:
+            clause = Clause(condition.subject, condition.object, beat, pivot)
+            reads.append((clause.subject_part, clause.real_subject_index))
+            if clause.object_indexed:
+                reads.append((clause.object_part, clause.real_object_index))
+        diffs = []
+        for modifier in self.rhs:
+            clause = Clause(modifier.subject, modifier.object, beat, pivot)
+            part = clause.subject_part
+            index = clause.real_subject_index % len(part.notes)
+            diffs.append((part, index, part.notes[index], clause.object_note))
+        reads = [(part, index % len(part.notes)) for part, index in reads]
+        return RuleLog(self, pivot, reads, diffs)
 
     def __str__(self):
         lhs = ', '.join(map(str, self.lhs))
@@ -257,6 +631,8 @@ class Rule(object):
 
 class Indexed(object):
 
+    __slots__ = ('part', 'index')
+
     def __init__(self, part, index):
         self.part = part
         self.index = index
@@ -266,68 +642,564 @@ class Indexed(object):
 
 class AnyIndexed(object):
 
+    __slots__ = ('part_index', 'index', 'bound')
+
     def __init__(self, part_index, index):
         self.part_index = part_index
         self.index = index
+        # pivot -> (ring, Indexed), see bind()
+        self.bound = {}
 
     def bind(self, bind_part):
-        part = bind_part.other_part_at(self.part_index)
-        return Indexed(part, self.index)
+        '''
+        Returns the Indexed this refers to when bind_part is the
+        pivot. It is made once for each pivot, and again only
+        when the parts have been linked up in a new ring.
+        '''
+        ring, indexed = self.bound.get(bind_part, (None, None))
+        if ring is not bind_part.ring:
+            indexed = Indexed(bind_part.other_part_at(self.part_index), self.index)
+            self.bound[bind_part] = (bind_part.ring, indexed)
+        return indexed
 
     def __str__(self):
         return '<%d>[%d]' % (self.part_index, self.index)
 
 class Comparator(object):
+    '''
+    Comparators order pauses before every note. function is
+    the same comparison on encoded notes, see encode_note(),
+    which is a plain integer comparison, for compiled rules.
+    '''
+
+    function = None
+
     def compare(self, note1, note2):
-        raise NotImplementedError()
+        return self.function(encode_note(note1), encode_note(note2))
 
 class CompEQ(Comparator):
-    def compare(self, note1, note2):
-        return note1 == note2
+    function = staticmethod(eq)
     def __str__(self):
         return '=='
 
 class CompNEQ(Comparator):
-    def compare(self, note1, note2):
-        return note1 != note2
+    function = staticmethod(ne)
     def __str__(self):
         return '!='
     
 class CompLT(Comparator):
-    def compare(self, note1, note2):
-        if note1 == PAUSE:
-            note1 = float("-inf")
-        if note2 == PAUSE:
-            note2 = float("-inf")
-        return note1 < note2
+    function = staticmethod(lt)
     def __str__(self):
         return '<'
 
 class CompLTE(Comparator):
-    def compare(self, note1, note2):
-        return CompEQ().compare(note1, note2) or CompLT().compare(note1, note2)
+    function = staticmethod(le)
     def __str__(self):
         return '<='
 
 class CompGT(Comparator):
-    def compare(self, note1, note2):
-        if note1 == PAUSE:
-            note1 = float("-inf")
-        if note2 == PAUSE:
-            note2 = float("-inf")
-        return note1 > note2
+    function = staticmethod(gt)
     def __str__(self):
         return '>'
 
 class CompGTE(Comparator):
-    def compare(self, note1, note2):
-        return CompEQ().compare(note1, note2) or CompGT().compare(note1, note2)
+    function = staticmethod(ge)
     def __str__(self):
         return '>='
 
+class CompiledRule(object):
+    '''
+    A rule specialised for one particular pivot part. Part
+    references and offsets are resolved when the rule is
+    compiled, so checking a beat is only a matter of integer
+    arithmetic on the part pointers, with no Clause objects
+    created along the way.
+
+    Beats are given as offsets from the start of the iteration.
+
+    Conditions are simplified first, see simplify_conditions().
+    If they can never all hold, never_matches is True and the
+    compiled rule can be left out altogether.
+    '''
+
+    def __init__(self, rule, pivot, parts):
+        self.rule = rule
+        self.pivot = pivot
+        self.resolved_conditions = simplify_conditions(
+            [resolve_condition(c, pivot, parts) for c in rule.lhs])
+        self.never_matches = self.resolved_conditions is None
+        if self.never_matches:
+            self.resolved_conditions = []
+        self.conditions = [compile_condition(c) for c in self.resolved_conditions]
+        self.modifiers = [compile_modifier(m, pivot, parts) for m in rule.rhs]
+
+        # the notes checked by can_alter(), in the order they are
+        # checked, and whether to check them before the conditions
+        # when possible, see order_checks()
+        self.alter_checks = [(part, offset, length)
+                             for part, offset, length, source in self.modifiers]
+        self.alter_first = False
+
+        # (part, offset, value) of the conditions that require a
+        # note to equal a value, for finding candidate beats
+        self.equalities = [(part, offset, object)
+                           for (part, offset), comparator, object in self.resolved_conditions
+                           if comparator.__class__ is CompEQ and not isinstance(object, tuple)]
+
+        # offsets read by the simplified conditions, for each part
+        self.read_offsets = {}
+        for subject, comparator, object in self.resolved_conditions:
+            for indexed in (subject, object):
+                if isinstance(indexed, tuple):
+                    part, offset = indexed
+                    self.read_offsets.setdefault(part, set()).add(offset)
+
+        # (part, offset) of every note read by the conditions
+        self.condition_reads = []
+        for condition in rule.lhs:
+            self.condition_reads.append(resolve_indexed(condition.subject, pivot, parts))
+            if isinstance(condition.object, (Indexed, AnyIndexed)):
+                self.condition_reads.append(resolve_indexed(condition.object, pivot, parts))
+
+        # names of all parts involved, pivot included
+        self.part_names = set([pivot.name])
+        for clause in rule.lhs + rule.rhs:
+            for indexed in (clause.subject, clause.object):
+                if isinstance(indexed, (Indexed, AnyIndexed)):
+                    self.part_names.add(resolve_indexed(indexed, pivot, parts)[0].name)
+
+    def signature(self):
+        '''
+        Compiled rules with the same signature read and write
+        the same notes in the same way, whatever rule or pivot
+        they were compiled from.
+        '''
+        conditions = frozenset((note_key(subject), comparator.__class__, value_key(object))
+                               for subject, comparator, object in self.resolved_conditions)
+        modifiers = tuple((part, offset % length, source.key)
+                          for part, offset, length, source in self.modifiers)
+        return conditions, modifiers
+
+    def phase(self):
+        '''
+        The pointers of the parts read by the conditions. As long
+        as these are the same, so are the notes read at each beat.
+        '''
+        return tuple(part.pointer for part in self.read_offsets)
+
+    def dirty_beats(self, changed, iteration_length, limit):
+        '''
+        Returns the beats whose conditions read one of the changed
+        notes, given as a dict from parts to sets of indices, or
+        None if there could be more than limit of them.
+        '''
+        reads = [(part, offsets, changed[part])
+                 for part, offsets in self.read_offsets.iteritems() if part in changed]
+        if not reads:
+            return ()
+        count = 0
+        for part, offsets, indices in reads:
+            length = len(part.notes)
+            count += len(indices) * len(offsets) * -(-iteration_length // length)
+        if count > limit:
+            return None
+
+        beats = set()
+        for part, offsets, indices in reads:
+            length = len(part.notes)
+            for index in indices:
+                for offset in offsets:
+                    first = (index - part.pointer - offset) % length
+                    beats.update(xrange(first, iteration_length, length))
+        return beats
+
+    def matches(self, i):
+        for condition in self.conditions:
+            if not condition(i):
+                return False
+        return True
+
+    def can_alter(self, i):
+        for part, offset, length in self.alter_checks:
+            if part.altered[(part.pointer + i + offset) % length]:
+                return False
+        return True
+
+    def order_checks(self, beats):
+        '''
+        Puts the checks made at each beat in the order expected
+        to rule out beats for the least work, judging by how
+        often each of them held at beats, a sample of the beats
+        of an iteration. A condition reading two notes costs
+        twice as much as one comparing a note to a value. None
+        of the checks have side effects, so the order does not
+        change what matches.
+        '''
+        beats = list(beats)
+        if not beats:
+            return
+
+        def pass_rate(check):
+            return sum(1 for i in beats if check(i)) / float(len(beats))
+
+        def cost_per_fail(cost, rate):
+            if rate == 1:
+                return float('inf')
+            return cost / (1 - rate)
+
+        rates = dict((condition, pass_rate(condition)) for condition in self.conditions)
+        self.conditions.sort(key = lambda c: cost_per_fail(c.cost, rates[c]))
+        conditions_cost = expected_cost([(c.cost, rates[c]) for c in self.conditions])
+
+        def unaltered(check):
+            part, offset, length = check
+            return lambda i: not part.altered[(part.pointer + i + offset) % length]
+
+        rates = dict((check, pass_rate(unaltered(check))) for check in self.alter_checks)
+        self.alter_checks.sort(key = lambda check: cost_per_fail(1, rates[check]))
+        alter_cost = expected_cost([(1, rates[check]) for check in self.alter_checks])
+
+        # checking can_alter() first costs alter_cost for every beat
+        # but saves the conditions at the beats it rules out
+        self.alter_first = \
+            alter_cost < (1 - pass_rate(self.can_alter)) * conditions_cost
+
+    def alter(self, i):
+        for part, offset, length, source in self.modifiers:
+            part.set_code_at(part.pointer + i + offset, source(i))
+
+    def log(self, i):
+        reads = [(part, (part.pointer + i + offset) % len(part.notes))
+                 for part, offset in self.condition_reads]
+        diffs = []
+        for part, offset, length, source in self.modifiers:
+            index = (part.pointer + i + offset) % length
+            diffs.append((part, index, decode_note(part.buffer[index]),
+                          decode_note(source(i))))
+        return RuleLog(self.rule, self.pivot, reads, diffs)
+
+def resolve_indexed(subject, pivot, parts):
+    '''
+    Returns the part and note offset that an Indexed or
+    AnyIndexed refers to when pivot is the pivot part. Parts
+    are looked up by name, so that rules can be compiled
+    against parts that were kept over a dynamic update.
+    '''
+    if isinstance(subject, AnyIndexed):
+        part = pivot.other_part_at(subject.part_index)
+    else:
+        part = subject.part
+    return parts[part.name], subject.index
+
+def resolve_condition(condition, pivot, parts):
+    '''
+    Returns (subject, comparator, object), where subject is a
+    (part, offset) tuple, and so is object unless it is an
+    encoded note.
+    '''
+    subject = resolve_indexed(condition.subject, pivot, parts)
+    object = condition.object
+    if isinstance(object, (Indexed, AnyIndexed)):
+        object = resolve_indexed(object, pivot, parts)
+    else:
+        object = encode_note(object)
+    return subject, condition.comparator, object
+
+def note_key(indexed):
+    part, offset = indexed
+    return part, offset % len(part.notes)
+
+def value_key(object):
+    if isinstance(object, tuple):
+        return note_key(object)
+    return object
+
+# comparators that always or never hold when comparing a note
+# to itself, or to a pause
+always_self = (CompEQ, CompLTE, CompGTE)
+never_self = (CompNEQ, CompLT, CompGT)
+always_pause = (CompGTE,)
+never_pause = (CompLT,)
+
+def simplify_conditions(conditions):
+    '''
+    Takes resolved conditions and drops the ones that are
+    repeated or always hold, or are implied by another, like
+    a[0] != _ by a[0] == 4. Returns None if the conditions can
+    never all hold: a note compared to itself with !=, < or >,
+    a note less than a pause, or a note required to equal two
+    different values, or to equal and not equal the same value.
+    '''
+    simplified = []
+    seen = set()
+    equals = {}
+    not_equals = set()
+    for subject, comparator, object in conditions:
+        subject_key = note_key(subject)
+        object_key = value_key(object)
+        comparator_class = comparator.__class__
+        key = (subject_key, comparator_class, object_key)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        if subject_key == object_key:
+            if comparator_class in never_self:
+                return None
+            if comparator_class in always_self:
+                continue
+        elif object == PAUSE_CODE:
+            if comparator_class in never_pause:
+                return None
+            if comparator_class in always_pause:
+                continue
+
+        if not isinstance(object, tuple):
+            if comparator_class is CompEQ:
+                if equals.get(subject_key, object) != object:
+                    return None
+                equals[subject_key] = object
+            elif comparator_class is CompNEQ:
+                not_equals.add((subject_key, object))
+        simplified.append((subject, comparator, object))
+
+    for subject_key, value in equals.items():
+        if (subject_key, value) in not_equals:
+            return None
+    return [(subject, comparator, object) for subject, comparator, object in simplified
+            if not (comparator.__class__ is CompNEQ and note_key(subject) in equals
+                    and not isinstance(object, tuple))]
+
+def compile_reader(indexed):
+    part, offset = indexed
+    length = len(part.notes)
+    def read(i):
+        return part.read_buffer[(part.pointer + i + offset) % length]
+    read.key = note_key(indexed)
+    return read
+
+def expected_cost(checks):
+    '''
+    The expected cost of a series of (cost, pass rate) checks
+    that stops at the first one that fails, assuming that they
+    pass independently of each other.
+    '''
+    total = 0.0
+    reached = 1.0
+    for cost, rate in checks:
+        total += reached * cost
+        reached *= rate
+    return total
+
+def compile_condition(resolved):
+    subject, comparator, object = resolved
+    compare = comparator.function
+    part, offset = subject
+    length = len(part.notes)
+
+    if isinstance(object, tuple):
+        read_object = compile_reader(object)
+        def matches(i):
+            return compare(part.read_buffer[(part.pointer + i + offset) % length],
+                           read_object(i))
+    else:
+        value = object
+        def matches(i):
+            return compare(part.read_buffer[(part.pointer + i + offset) % length],
+                           value)
+    # relative cost, see CompiledRule.order_checks()
+    matches.cost = 2 if isinstance(object, tuple) else 1
+    return matches
+
+def compile_modifier(modifier, pivot, parts):
+    part, offset = resolve_indexed(modifier.subject, pivot, parts)
+    if isinstance(modifier.object, (Indexed, AnyIndexed)):
+        source = compile_reader(resolve_indexed(modifier.object, pivot, parts))
+    else:
+        value = encode_note(modifier.object)
+        source = lambda i: value
+        source.key = value
+    return (part, offset, len(part.notes), source)
+
+def is_pivot_independent(rule):
+    '''
+    True if the rule only refers to parts by name, in which case
+    it does the same thing whatever the pivot.
+    '''
+    for clause in rule.lhs + rule.rhs:
+        for indexed in (clause.subject, clause.object):
+            if isinstance(indexed, AnyIndexed):
+                return False
+    return True
+
+def rule_pivots(rule, part_order):
+    '''
+    The pivots a rule is compiled for. A pivot independent rule
+    only needs the first: for the others it would read the same
+    notes, and only find its notes already altered.
+    '''
+    if is_pivot_independent(rule):
+        return part_order[:1]
+    return part_order
+
+def compile_rules(rules, part_order, parts):
+    '''
+    Rules are applied in source order, and each rule for every
+    part in part_order as pivot.
+    '''
+    return prune_compiled_rules([CompiledRule(rule, pivot, parts)
+                                 for rule in rules
+                                 for pivot in rule_pivots(rule, part_order)])
+
+def prune_compiled_rules(compiled_rules):
+    '''
+    Leaves out compiled rules that can never match, and the ones
+    with the same signature as an earlier one. Such a rule reads
+    the same notes as the earlier one, so it matches on the same
+    beats, and then finds the notes it would write already
+    altered, either by the earlier rule or by whatever blocked
+    it. Rules without modifiers are kept, since they still show
+    up in the rule log.
+    '''
+    pruned = []
+    signatures = set()
+    for compiled in compiled_rules:
+        if compiled.never_matches:
+            continue
+        if compiled.modifiers:
+            signature = compiled.signature()
+            if signature in signatures:
+                continue
+            signatures.add(signature)
+        pruned.append(compiled)
+    return pruned
+
+def rule_warnings(rules, part_order, parts):
+    '''
+    Returns warnings about conditions that are repeated within
+    a rule, and rules that can never match for any pivot.
+    '''
+    warnings = []
+    for rule in rules:
+        seen = set()
+        for condition in rule.lhs:
+            if str(condition) in seen:
+                warnings.append('Repeated condition %s in rule %s' % (condition, rule))
+            seen.add(str(condition))
+        if part_order and all(CompiledRule(rule, pivot, parts).never_matches
+                              for pivot in rule_pivots(rule, part_order)):
+            warnings.append('Rule %s can never match' % rule)
+    return warnings
+
+def midi_warnings(parts, compiled_rules):
+    '''
+    Returns warnings about notes that can not be played once the
+    properties of their part are applied. Every note that a part
+    may come to hold is checked: its own notes, the values rules
+    write to it, and the notes rules copy into it from other
+    parts, and from there on.
+    '''
+    values = dict((part, set(part.buffer)) for part in parts.values())
+    sources = dict((part, set()) for part in parts.values())
+    for compiled in compiled_rules:
+        for part, offset, length, source in compiled.modifiers:
+            if isinstance(source.key, tuple):
+                sources[part].add(source.key[0])
+            else:
+                values[part].add(source.key)
+
+    changed = True
+    while changed:
+        changed = False
+        for part, source_parts in sources.iteritems():
+            for source_part in source_parts:
+                if not values[source_part] <= values[part]:
+                    values[part] |= values[source_part]
+                    changed = True
+
+    warnings = []
+    for name, part in sorted(parts.items()):
+        # velocities are kept in range by Part.set_property()
+        channel = part.properties['channel']
+        if channel > 15:
+            warnings.append('Bad channel number %d in part %s, whose notes will not be played' %
+                            (channel, name))
+            continue
+        codes = [code for code in values[part]
+                 if code != PAUSE_CODE and not 0 <= code + part.midi_offset <= 127]
+        if codes:
+            warnings.append('Note(s) %s of part %s are outside the MIDI range once '
+                            'transposed, and will not be played' %
+                            (', '.join(map(str, sorted(codes))), name))
+    return warnings
+
+class CycleDetector(object):
+    '''
+    Finds out when the engine gets back to a state it has been
+    in before. Only hashes of past states are kept. When a hash
+    repeats, the states of one period are recorded, and the cycle
+    is confirmed if the engine then gets back to the first of
+    them.
+    '''
+
+    def __init__(self, max_history = 10000):
+        self.max_history = max_history
+        self.reset()
+
+    def reset(self):
+        self.hashes = {}
+        self.order = deque()
+        self.recording = None
+        self.cycle = None
+        self.states = None
+
+    def add(self, iteration, state):
+        '''
+        Returns True when a cycle has just been confirmed.
+        '''
+        if self.recording is not None:
+            start, period, states = self.recording
+            if len(states) < period:
+                states.append(state)
+                return False
+            self.recording = None
+            if state == states[0]:
+                self.cycle = (start, period)
+                self.states = states
+                return True
+            # hash collision
+            return False
+
+        state_hash = hash(state)
+        if state_hash in self.hashes:
+            start = self.hashes[state_hash]
+            self.recording = (start, iteration - start, [state])
+            return False
+
+        self.hashes[state_hash] = iteration
+        self.order.append(state_hash)
+        if len(self.order) > self.max_history:
+            del self.hashes[self.order.popleft()]
+        return False
+
 class Engine(object):
 
-    def __init__(self, parts, rules, part_order, config):
+    # share of a part's notes that the value of an equality
+    # condition can be found at for it to be worth only checking
+    # those beats, see candidate_beats()
+    max_candidates = 0.5
+
+    # every so many iterations, compiled rules reorder their checks
+    # by what they observe at a sample of about this many beats,
+    # see CompiledRule.order_checks()
+    reorder_interval = 16
+    reorder_sample = 32
+
+    def __init__(self, parts, rules, part_order, config = None,
+                 detect_cycles = True, incremental = True):
+
+        if config is None:
+            config = Config()
 
         self.parts = parts
 
@@ -344,89 +1216,435 @@ class Engine(object):
         
         link_parts(part_order)
         self.part_order = part_order
+        self.logger = Logger()
+        self.profiler = Profiler()
+
+        # beats matched by each compiled rule in the last iteration,
+        # see find_matches()
+        self.incremental = incremental
+        self.match_cache = {}
+        self.changed = {}
+        # beats the conditions of rules have been evaluated for, in
+        # all iterations so far
+        self.evaluated = 0
+
+        self.compiled_rules = None
+        self.compile_rules()
+
+        self.iteration = 0
+        self.cycle_detector = CycleDetector() if detect_cycles else None
+        self.cycle_position = 0
+        self.cycle_midi_notes = None
+        self.state_parts = None
+        self.reset_cycle()
+
+    @property
+    def cycle(self):
+        '''
+        (start, period) once the engine has been found to repeat
+        itself, otherwise None. start is the first iteration of
+        the cycle.
+        '''
+        if self.cycle_detector:
+            return self.cycle_detector.cycle
+        return None
 
     def longest_part_length(self):
         return reduce(lambda x, y: max(x, len(y.notes)), self.parts.values(), 0)
 
+    def update(self, parts, rules, part_order, config):
+        '''
+        Updates the engine to a newly parsed program, changing as
+        little as possible. Parts whose notes did not change are
+        kept along with their state, and compiled rules are reused
+        unless the rule or one of the parts it involves changed.
+        Returns a list of what was changed.
+        '''
+        if config.get('partorder'):
+            part_order = config.get('partorder')
+
+        swapped = self.update_parts(parts)
+        restyled = self.update_properties(parts)
+        reordered = self.update_part_order(part_order, swapped)
+        rules_changed = self.update_rules(rules)
+        resized = self.update_config(config)
+
+        if reordered:
+            self.compile_rules()
+        elif swapped or rules_changed:
+            self.compile_rules(swapped)
+
+        if swapped or reordered or rules_changed or resized:
+            self.reset_cycle()
+        elif restyled and self.cycle:
+            self.cycle_midi_notes = [None] * self.cycle[1]
+
+        changes = []
+        if swapped:
+            changes.append('parts ' + ', '.join(sorted(swapped)))
+        if restyled:
+            changes.append('part properties')
+        if reordered:
+            changes.append('part order')
+        if rules_changed:
+            changes.append('rules')
+        if resized:
+            changes.append('iteration length')
+        return changes
+
     def update_parts(self, parts):
-        deleted = self.parts.keys()
+        '''
+        Swaps in the parts that are new or whose notes changed,
+        and removes the ones that are gone. Returns the names of
+        the parts that were swapped in or removed.
+        '''
+        swapped = set()
+        for name in self.parts.keys():
+            if name not in parts:
+                del self.parts[name]
+                swapped.add(name)
         for name, part in parts.iteritems():
-            deleted = filter(lambda x: x != name, deleted)
-            if name not in self.parts or part.notes != self.parts[name].original_notes:
+            if name not in self.parts or \
+                    part.original_notes != self.parts[name].original_notes:
                 self.parts[name] = part
-            self.parts[name].properties = part.properties
-        for name in deleted:
-            del parts[name]
+                swapped.add(name)
+        return swapped
+
+    def update_properties(self, parts):
+        '''
+        Copies over the properties of the parts that were kept.
+        Returns True if any of them changed.
+        '''
+        changed = False
+        for name, part in parts.iteritems():
+            kept_part = self.parts[name]
+            if kept_part is not part and kept_part.properties != part.properties:
+                kept_part.properties = part.properties
+                kept_part.refresh_midi()
+                changed = True
+        return changed
 
     def update_rules(self, rules):
+        '''
+        Returns True if the rules are different from before.
+        '''
+        changed = map(str, rules) != map(str, self.rules)
         self.rules = rules
+        return changed
 
-    def update_part_order(self, part_order):
-        def part_name(part):
-            return part.name
-        if map(part_name, part_order) != (part_name, self.part_order):
-            new_part_order = []
-            for part in part_order:
-                new_part_order.append(self.parts[part.name])
-            self.part_order = new_part_order
+    def update_part_order(self, part_order, swapped = ()):
+        '''
+        Links up the parts in the new order, which refers to parts
+        by name. Returns True if the order changed.
+        '''
+        names = [part.name for part in part_order]
+        reordered = names != [part.name for part in self.part_order]
+        if reordered or swapped:
+            self.part_order = [self.parts[name] for name in names]
             link_parts(self.part_order)
-    
+        return reordered
+
     def update_config(self, config):
+        '''
+        Returns True if the iteration length changed.
+        '''
+        iteration_length = self.iteration_length
         iterlength = config.get('iterlength')
         if iterlength is None:
             self.iteration_length = self.longest_part_length()
         else:
             self.iteration_length = iterlength
+        return self.iteration_length != iteration_length
+
+    def compile_rules(self, swapped = None):
+        '''
+        Compiles every rule for every pivot part. If swapped is
+        given, rules compiled earlier are reused, except those
+        involving one of the swapped parts.
+        '''
+        self.match_cache = {}
+        if swapped is None or self.compiled_rules is None:
+            self.compiled_rules = compile_rules(self.rules, self.part_order, self.parts)
+            return
+
+        previous = {}
+        for compiled in self.compiled_rules:
+            if not compiled.part_names & swapped:
+                previous[(str(compiled.rule), compiled.pivot.name)] = compiled
+        compiled_rules = []
+        for rule in self.rules:
+            for pivot in rule_pivots(rule, self.part_order):
+                compiled = previous.get((str(rule), pivot.name))
+                if compiled is None:
+                    compiled = CompiledRule(rule, pivot, self.parts)
+                compiled_rules.append(compiled)
+        self.compiled_rules = prune_compiled_rules(compiled_rules)
 
     def get_midi_notes(self):
         '''
         Returns a list of time steps, each element being a list of notes.
         '''
-        midi_notes = []
-        for i in range(self.iteration_length):
-            midi_notes.append([])
-            for part in self.parts.values():
-                midi_note = part.get_midi_note_at(part.pointer + i)
-                if midi_note:
-                    midi_notes[i].append(midi_note)
+        if self.cycle:
+            midi_notes = self.cycle_midi_notes[self.cycle_position]
+            if midi_notes is None:
+                midi_notes = self.make_midi_notes()
+                self.cycle_midi_notes[self.cycle_position] = midi_notes
+            return midi_notes
+        return self.make_midi_notes()
+
+    def make_midi_notes(self):
+        midi_notes = [[] for i in xrange(self.iteration_length)]
+        for part in self.parts.values():
+            for i, midi_note in part.midi_events(self.iteration_length):
+                midi_notes[i].append(midi_note)
         return midi_notes
 
     def iterate(self):
+        if self.cycle:
+            self.replay()
+            return
+
         self.reset_altered()
         self.notes_read_copy()
+        self.apply_rules()
+        if self.iteration % self.reorder_interval == 0:
+            self.order_checks()
+        self.update_pointers()
+
+        self.iteration += 1
+        if self.cycle_detector and \
+                self.cycle_detector.add(self.iteration, self.get_state()):
+            start, period = self.cycle
+            self.cycle_position = 0
+            self.cycle_midi_notes = [None] * period
+
+    def order_checks(self):
+        '''
+        Called after the rules have been applied, when the
+        altered flags show which beats rules were blocked at.
+        '''
+        step = max(1, self.iteration_length // self.reorder_sample)
+        beats = xrange(0, self.iteration_length, step)
+        for compiled in self.compiled_rules:
+            compiled.order_checks(beats)
+
+    def close(self):
+        '''
+        Releases whatever the engine holds on to besides memory.
+        '''
+        pass
+
+    def apply_rules(self):
+        if self.profiler.enabled:
+            self.profile_rules()
+            return
 
         # Rules are applied for each part as a pivot, for each beat.
-        # TODO: optimise
-        for rule in self.rules:
-            for pivot in self.part_order:
-                for beat in self.beats():
-                    rule.apply(beat, pivot)
+        # Matches are found up front, since conditions only read
+        # the notes as they were before the iteration.
+        for compiled in self.compiled_rules:
+            can_alter = compiled.can_alter
+            matches, evaluated = self.find_matches(compiled)
+            self.evaluated += evaluated
+            for i in matches:
+                if can_alter(i):
+                    self.alter(compiled, i)
+
+    def profile_rules(self):
+        '''
+        Like apply_rules(), but recording what happens in the
+        profiler.
+        '''
+        for compiled in self.compiled_rules:
+            started = time.time()
+            matches, evaluated = self.find_matches(compiled)
+            self.evaluated += evaluated
+            blocked = 0
+            for i in matches:
+                if compiled.can_alter(i):
+                    self.alter(compiled, i)
+                else:
+                    blocked += 1
+            self.profiler.add(compiled.rule, evaluated, len(matches), blocked,
+                              time.time() - started)
+        self.profiler.iterations += 1
+
+    def find_matches(self, compiled):
+        '''
+        Returns the beats where the conditions of compiled hold, in
+        order, and the number of beats that were evaluated to find
+        out. When incremental, the matches are remembered, and if
+        the parts read are at the same pointers next iteration,
+        only the beats that read notes changed in between are
+        evaluated again.
+        '''
+        if not self.incremental:
+            return self.match_all(compiled)
+
+        phase = compiled.phase()
+        cached = self.match_cache.get(compiled)
+        beats = None
+        if cached is not None and cached[0] == phase:
+            # when many notes have changed it is quicker to start over
+            beats = compiled.dirty_beats(self.changed, self.iteration_length,
+                                         self.iteration_length / 2)
+        if beats is None:
+            matches, evaluated = self.match_all(compiled)
+            self.match_cache[compiled] = (phase, matches)
+            return matches, evaluated
+
+        phase, matches = cached
+        if not beats:
+            return matches, 0
+        matched = set(matches)
+        for i in beats:
+            if compiled.matches(i):
+                matched.add(i)
+            else:
+                matched.discard(i)
+        matches = sorted(matched)
+        self.match_cache[compiled] = (phase, matches)
+        return matches, len(beats)
 
-        self.update_pointers()
+    def match_all(self, compiled):
+        '''
+        Evaluates compiled for every beat it could match at.
+        Returns the matches and the number of beats evaluated.
+        '''
+        matches = compiled.matches
+        candidates = self.candidate_beats(compiled)
+        if candidates is None:
+            candidates = xrange(self.iteration_length)
+        if compiled.alter_first and not self.incremental and not self.profiler.enabled:
+            # the matches are applied right away, and notes are never
+            # unaltered within an iteration, so matches at the beats
+            # left out would have been blocked anyway
+            can_alter = compiled.can_alter
+            candidates = [i for i in candidates if can_alter(i)]
+        return [i for i in candidates if matches(i)], len(candidates)
+
+    def candidate_beats(self, compiled):
+        '''
+        If compiled requires a note to equal a value, returns the
+        beats where that note currently has that value, in order,
+        picking the value that is rarest in its part. Returns None
+        if there is no such condition, or if the value is found at
+        more than max_candidates of the positions, in which case
+        it is quicker to check every beat.
+        '''
+        best = None
+        for part, offset, value in compiled.equalities:
+            positions = part.positions_of(value)
+            share = len(positions) / float(len(part.notes))
+            if best is None or share < best[0]:
+                best = (share, part, offset, positions)
+        if best is None or best[0] > self.max_candidates:
+            return None
+
+        share, part, offset, positions = best
+        length = len(part.notes)
+        beats = []
+        for index in positions:
+            first = (index - part.pointer - offset) % length
+            beats.extend(xrange(first, self.iteration_length, length))
+        beats.sort()
+        return beats
+
+    def alter(self, compiled, i):
+        if self.logger.enabled:
+            self.logger.add(compiled.log(i))
+        compiled.alter(i)
 
     def reset_altered(self):
         for part in self.parts.values():
             part.reset_altered()
 
     def beats(self):
-        beats = []
-        for i in range(self.iteration_length):
-            beats.append({})
-            for part in self.parts.values():
-                index = (part.pointer + i) % len(part.notes)
-                beats[i][part.name] = Indexed(part, index)
-        return beats
+        '''
+        Yields the beats of the iteration as dicts, see beat().
+        Rules take beats as plain offsets, so this is only for
+        inspecting where each part is.
+        '''
+        for i in xrange(self.iteration_length):
+            yield self.beat(i)
+
+    def beat(self, i):
+        '''
+        Returns a dict from part names to the Indexed that each
+        part is at, i beats into the iteration.
+        '''
+        beat = {}
+        for part in self.parts.values():
+            index = (part.pointer + i) % len(part.notes)
+            beat[part.name] = Indexed(part, index)
+        return beat
 
     def notes_read_copy(self):
+        # the notes changed since the last copy are the ones that
+        # remembered matches may no longer hold for
+        self.changed = {}
         for part in self.parts.values():
+            if part.changed is None:
+                # the notes were replaced without set_note_at()
+                self.match_cache = {}
+            elif part.changed:
+                self.changed[part] = part.changed
             part.create_notes_copy()
+            part.changed = set()
 
     def update_pointers(self):
         for part in self.parts.values():
             part.pointer = (part.pointer + self.iteration_length) % len(part.notes)
 
+    def rewind(self, steps):
+        '''
+        Moves every part back by steps, for when playback of an
+        iteration was cut short.
+        '''
+        if not steps:
+            return
+        for part in self.parts.values():
+            part.pointer = (part.pointer - steps) % len(part.notes)
+        self.reset_cycle()
+
+    def replay(self):
+        '''
+        Once in a cycle, iterating is just a matter of restoring
+        the next recorded state.
+        '''
+        start, period = self.cycle
+        self.iteration += 1
+        self.cycle_position = (self.cycle_position + 1) % period
+        self.set_state(self.cycle_detector.states[self.cycle_position])
+
+    def reset_cycle(self):
+        '''
+        Called whenever the program changes, since the states
+        seen so far are no longer relevant, and neither are the
+        matches remembered.
+        '''
+        self.state_parts = [self.parts[name] for name in sorted(self.parts.keys())]
+        self.match_cache = {}
+        if not self.cycle_detector:
+            return
+        self.cycle_detector.reset()
+        self.cycle_detector.add(self.iteration, self.get_state())
+        self.cycle_midi_notes = None
+
+    def get_state(self):
+        return tuple(part.get_state() for part in self.state_parts)
+
+    def set_state(self, state):
+        for part, part_state in zip(self.state_parts, state):
+            part.set_state(part_state)
+
 
 def link_parts(part_order):
-    for i, part in enumerate(part_order):
-        part.next_part = part_order[(i + 1) % len(part_order)]
-        part.prev_part = part_order[(i - 1) % len(part_order)]
+    '''
+    Arranges the parts in a ring, in which each part knows its
+    own position, so that Part.other_part_at() is a lookup.
+    '''
+    ring = tuple(part_order)
+    for i, part in enumerate(ring):
+        part.ring = ring
+        part.ring_index = i
@@ -0,0 +1,153 @@
+# Celltone - Generative music composition using cellular automata
+# Copyright (C) 2012   andreas@jansson.me.uk
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''
+Multi-core backend for the engine. Conditions only read the notes
+as they were before the iteration, so the beats where each compiled
+rule matches are found by a pool of processes, reading the notes
+from shared memory. The matches are then committed in the main
+process, in the same order as the plain engine, so that the altered
+flags work exactly the same.
+'''
+
+from model import *
+import ctypes
+import multiprocessing
+
+class ParallelEngine(Engine):
+
+    # below this many beats to evaluate per iteration, it is
+    # quicker to do it in this process
+    min_parallel_beats = 20000
+
+    def __init__(self, parts, rules, part_order, config = None, jobs = None,
+                 **options):
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.pool = None
+        # matches are found from scratch every iteration by the
+        # pool, so there is nothing to remember
+        options.setdefault('incremental', False)
+        Engine.__init__(self, parts, rules, part_order, config, **options)
+
+    def apply_rules(self):
+        if self.profiler.enabled or \
+                len(self.compiled_rules) * self.iteration_length < self.min_parallel_beats:
+            Engine.apply_rules(self)
+            return
+
+        if self.pool is None:
+            self.start_pool()
+        self.share_notes()
+        # the pool evaluates every beat
+        self.evaluated += len(self.compiled_rules) * self.iteration_length
+        for compiled, matches in zip(self.compiled_rules, self.pool_matches()):
+            can_alter = compiled.can_alter
+            for i in matches:
+                if can_alter(i):
+                    self.alter(compiled, i)
+
+    def start_pool(self):
+        '''
+        Forks the pool, which inherits the compiled rules and the
+        parts they refer to. Only the notes and pointers change
+        between iterations, and those are passed in shared memory.
+        '''
+        self.shared_parts = sorted(self.parts.values(), key = lambda part: part.name)
+        self.starts = []
+        size = 0
+        for part in self.shared_parts:
+            self.starts.append(size)
+            size += len(part.notes)
+        # the same encoding as the note buffers of the parts
+        self.shared_notes = multiprocessing.Array('h', size, lock = False)
+        self.shared_pointers = multiprocessing.Array('l', len(self.shared_parts), lock = False)
+
+        # compiled rules are dealt out round robin, since rules
+        # next to each other tend to cost about the same
+        count = len(self.compiled_rules)
+        chunks = min(self.jobs * 4, count)
+        self.chunks = [range(i, count, chunks) for i in range(chunks)]
+        self.pool = multiprocessing.Pool(
+            self.jobs, init_worker,
+            (self.compiled_rules, self.shared_parts, self.starts,
+             self.shared_notes, self.shared_pointers, self.iteration_length))
+
+    def share_notes(self):
+        base = ctypes.addressof(self.shared_notes)
+        itemsize = ctypes.sizeof(ctypes.c_short)
+        for i, part in enumerate(self.shared_parts):
+            address, length = part.read_buffer.buffer_info()
+            ctypes.memmove(base + self.starts[i] * itemsize, address, length * itemsize)
+            self.shared_pointers[i] = part.pointer
+
+    def pool_matches(self):
+        '''
+        Returns the matches of every compiled rule, in order.
+        '''
+        matches = [None] * len(self.compiled_rules)
+        for chunk, chunk_matches in zip(self.chunks,
+                                        self.pool.map(find_matches, self.chunks)):
+            for i, beats in zip(chunk, chunk_matches):
+                matches[i] = beats
+        return matches
+
+    def compile_rules(self, swapped = None):
+        Engine.compile_rules(self, swapped)
+        # the pool has the old compiled rules
+        self.close()
+
+    def reset_cycle(self):
+        Engine.reset_cycle(self)
+        # parts may have been swapped, or the iteration length
+        # changed
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+# state of a worker process, set up by init_worker()
+worker = {}
+
+def init_worker(compiled_rules, parts, starts, shared_notes, shared_pointers,
+                iteration_length):
+    # the compiled rules read the notes straight from shared memory
+    itemsize = ctypes.sizeof(ctypes.c_short)
+    for part, start in zip(parts, starts):
+        part.read_buffer = (ctypes.c_short * len(part.buffer)).from_buffer(
+            shared_notes, start * itemsize)
+    worker['compiled_rules'] = compiled_rules
+    worker['parts'] = parts
+    worker['shared_pointers'] = shared_pointers
+    worker['iteration_length'] = iteration_length
+
+def find_matches(chunk):
+    '''
+    Returns the matches of the compiled rules at the indices in
+    chunk, reading the pointers of the parts from shared memory.
+    '''
+    for i, part in enumerate(worker['parts']):
+        part.pointer = worker['shared_pointers'][i]
+
+    beats = xrange(worker['iteration_length'])
+    chunk_matches = []
+    for i in chunk:
+        matches = worker['compiled_rules'][i].matches
+        chunk_matches.append([beat for beat in beats if matches(beat)])
+    return chunk_matches
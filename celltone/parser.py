@@ -20,7 +20,11 @@
 
 import ply.lex as lex
 import ply.yacc as yacc
+from copy import copy
+import os
+import re
 import sys
+import threading
 from model import *
 
 tokens = (
@@ -101,11 +105,25 @@ def t_error(t):
     raise SyntaxError(t.lineno, "Illegal character '%s'" % t.value[0])
 
 
+class Program(object):
+    '''
+    The parts, rules and config of a program, filled in during
+    parsing. Grammar rules get the one being parsed through
+    p.lexer.program, since every Parser has its own lexer.
+    '''
 
-parts = {}
-rules = []
-part_order = []
-config = Config()
+    def __init__(self):
+        self.parts = {}
+        self.rules = []
+        self.part_order = []
+        self.config = Config()
+
+    def add_part(self, name, notes, lineno):
+        if name in self.parts:
+            raise SemanticError(lineno, "Cannot redefine part '%s'" % name)
+        part = Part(name, notes)
+        self.parts[name] = part
+        self.part_order.append(part)
 
 def p_program(p):
     '''program : program statement
@@ -123,21 +141,20 @@ def p_empty(p):
 
 def p_partassign(p):
     'partassign : ID ASSIGN notelist'
-    if p[1] in parts:
-        raise SemanticError(p.lineno(1), "Cannot redefine part '%s'" % p[1])
-    part = Part(p[1], p[3])
-    parts[p[1]] = part
-    part_order.append(part)
+    p.lexer.program.add_part(p[1], p[3], p.lineno(1))
 
 def p_notelist(p):
     'notelist : LSQUARE notes RSQUARE'
-    p[0] = p[2]
+    p[0] = p[2][::-1]
     if len(p[0]) == 0:
         raise SemanticError(p.lineno(1), 'Empty note lists are not permitted')
 
+# notes are collected in reverse, since appending is a lot faster
+# than prepending to long lists
 def p_notes_list(p):
     'notes : note COMMA notes'
-    p[0] = [p[1]] + p[3]
+    p[0] = p[3]
+    p[0].append(p[1])
 
 def p_notes_single(p):
     'notes : note'
@@ -149,6 +166,9 @@ def p_notes_empty_error(p):
 
 def p_note_number(p):
     'note : NUMBER'
+    if p[1] < MIN_NOTE or p[1] > MAX_NOTE:
+        raise SemanticError(p.lineno(1), 'Notes must be between %d and %d' %
+                            (MIN_NOTE, MAX_NOTE))
     p[0] = p[1]
 
 def p_note_pause(p):
@@ -157,6 +177,7 @@ def p_note_pause(p):
 
 def p_property(p):
     'property : ID DOT ID'
+    parts = p.lexer.program.parts
     if p[1] not in parts:
         raise SemanticError(p.lineno(1), "Undefined part '%s'" % p[1])
     p[0] = {'part': parts[p[1]], 'prop': p[3]}
@@ -173,7 +194,7 @@ def p_propassign_number(p):
 
 def p_rule(p):
     'rule : lhs BECOMES rhs'
-    rules.append(Rule(p[1], p[3]))
+    p.lexer.program.rules.append(Rule(p[1], p[3]))
 
 def p_lhs(p):
     'lhs : LCURLY conditions RCURLY'
@@ -197,6 +218,7 @@ def p_condition(p):
 
 def p_indexed(p):
     'indexed : ID LSQUARE NUMBER RSQUARE'
+    parts = p.lexer.program.parts
     if p[1] not in parts:
         raise SemanticError(p.lineno(1), 'Undefined part \'%s\'' % p[1])
     p[0] = Indexed(parts[p[1]], p[3])
@@ -254,7 +276,7 @@ def p_confassign(p):
     '''confassign : OPTION ASSIGN NUMBER
                   | OPTION ASSIGN partlist'''
     try:
-        config.set(p[1], p[3])
+        p.lexer.program.config.set(p[1], p[3])
     except Exception as e:
         raise SemanticError(p.lineno(1), str(e))
 
@@ -270,7 +292,7 @@ def p_parts_list(p):
 
 def p_parts_single(p):
     'parts : ID'
-    p[0] = parts[p[1]]
+    p[0] = p.lexer.program.parts[p[1]]
 
 def p_parts_empty_error(p):
     'parts : empty'
@@ -282,22 +304,116 @@ def p_error(p):
     else:
         raise ParseError('Syntax error near end of file')
 
+# The lexer and parser are built once per process, from the
+# tables in lextab.py and parsetab.py. If the tables don't match
+# the grammar or the installed PLY version, PLY regenerates them
+# in memory without writing anything to disk. Each Parser works
+# on its own copies, which share the tables.
+lexer = None
+yacc_parser = None
+build_lock = threading.Lock()
+
+def build():
+    global lexer, yacc_parser
+    with build_lock:
+        if yacc_parser is None:
+            lexer = lex.lex(optimize = 1, lextab = 'lextab')
+            yacc_parser = yacc.yacc(debug = 0, tabmodule = 'parsetab',
+                                    write_tables = 0)
+
+def write_tables():
+    '''
+    Regenerates lextab.py and parsetab.py. Has to be run whenever
+    the grammar changes:
+
+        python -m celltone.parser
+    '''
+    outputdir = os.path.dirname(os.path.abspath(__file__))
+    lex.lex().writetab('lextab', outputdir)
+    yacc.yacc(debug = 0, tabmodule = 'parsetab', outputdir = outputdir)
+
 class Parser(object):
+    '''
+    Parsers don't share any state, so separate threads can parse
+    at the same time as long as they use different Parsers.
+
+    Code is parsed statement by statement, and the notes of
+    statements that only define a part are remembered until the
+    next parse. Reparsing a long file after a small edit then
+    mostly skips over the long note lists.
+    '''
 
     def __init__(self):
-        global parts, rules, part_order, config
-        parts = {}
-        rules = []
-        part_order = []
-        config = Config()
-        
-        lex.lex()
-        from celltone import celltone_home
-        yacc.yacc(debug = 0, tabmodule = 'ply_parsetab', outputdir = celltone_home)
+        build()
+        self.lexer = lexer.clone()
+        self.parser = copy(yacc_parser)
+        self.part_statements = {}
 
     def parse(self, code):
-        yacc.parse(code)
-        return (parts, rules, part_order, config)
+        statements = split_statements(code)
+        program = Program()
+        self.lexer.program = program
+        part_statements = {}
+        try:
+            if not statements:
+                raise ParseError('No statements')
+            for lineno, statement in statements:
+                self.parse_statement(statement, lineno, part_statements)
+        except ParseError:
+            # statements are only split by a heuristic, so errors are
+            # reported from parsing the whole thing
+            program = Program()
+            self.lexer.program = program
+            self.lexer.lineno = 1
+            self.parser.parse(code, lexer = self.lexer)
+        self.part_statements = part_statements
+        return (program.parts, program.rules, program.part_order, program.config)
+
+    def parse_statement(self, statement, lineno, part_statements):
+        program = self.lexer.program
+        text = comment.sub('', statement).strip()
+        if text in self.part_statements:
+            name, notes = self.part_statements[text]
+            program.add_part(name, list(notes), lineno)
+        else:
+            self.lexer.lineno = lineno
+            self.parser.parse(statement, lexer = self.lexer)
+        if part_statement.match(text):
+            part = program.part_order[-1]
+            part_statements[text] = (part.name, part.original_notes)
+
+comment = re.compile(r'#.*')
+
+# a statement that does nothing but define a part
+part_statement = re.compile(r'[a-zA-Z][a-zA-Z0-9_]*\s*=\s*\[[-+\d_,\s]*\]$')
+
+# lines that look like the start of a statement
+statement_start = re.compile(r'[ \t]*([a-zA-Z][a-zA-Z0-9_]*[ \t]*(=[ \t]*\[|\.)|<[a-zA-Z]|\{)')
+
+def split_statements(code):
+    '''
+    Splits code into chunks of whole lines, each of which should
+    hold one or more complete statements. Returns a list of (line
+    number, chunk) tuples, leaving out chunks with only comments.
+    '''
+    chunks = []
+    start = 1
+    lines = []
+    previous = ''
+    for lineno, line in enumerate(code.split('\n'), 1):
+        text = comment.sub('', line).strip()
+        # the right hand side of a rule can start on a line of its own
+        if statement_start.match(line) and \
+                not (text.startswith('{') and previous.endswith('=>')):
+            chunks.append((start, '\n'.join(lines)))
+            start = lineno
+            lines = []
+        lines.append(line)
+        if text:
+            previous = text
+    chunks.append((start, '\n'.join(lines)))
+    return [(lineno, chunk) for lineno, chunk in chunks
+            if comment.sub('', chunk).strip()]
 
 class ParseError(Exception):
     pass
@@ -319,3 +435,5 @@ class SemanticError(ParseError):
 def is_midi_number(n):
     return n >= 0 and n <= 127
 
+if __name__ == '__main__':
+    write_tables()
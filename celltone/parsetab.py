@@ -0,0 +1,77 @@
+
+# parsetab.py
+# This file is automatically generated. Do not edit.
+# pylint: disable=W,C,R
+_tabversion = '3.10'
+
+_lr_method = 'LALR'
+
+_lr_signature = 'ANYINDEX ASSIGN BECOMES COMMA DOT EQ GT GTE ID LCURLY LSQUARE LT LTE NEQ NUMBER OPTION PAUSE RCURLY RSQUAREprogram : program statement\n               | statementstatement : partassign\n                 | propassign\n                 | rule\n                 | confassignempty :partassign : ID ASSIGN notelistnotelist : LSQUARE notes RSQUAREnotes : note COMMA notesnotes : notenotes : emptynote : NUMBERnote : PAUSEproperty : ID DOT IDpropassign : property ASSIGN NUMBERrule : lhs BECOMES rhslhs : LCURLY conditions RCURLYconditions : condition COMMA conditionsconditions : conditionconditions : emptycondition : subject comparator objectindexed : ID LSQUARE NUMBER RSQUAREanyindexed : ANYINDEX LSQUARE NUMBER RSQUAREcomparator : EQ\n                  | NEQ\n                  | LT\n                  | LTE\n                  | GT\n                  | GTEobject : note\n              | indexed\n              | anyindexedrhs : LCURLY modifiers RCURLYmodifiers : modifier COMMA modifiersmodifiers : modifiermodifiers : emptymodifier : subject ASSIGN objectmodifier : subjectsubject : indexed\n               | anyindexedconfassign : OPTION ASSIGN NUMBER\n                  | OPTION ASSIGN partlistpartlist : LSQUARE parts RSQUAREparts : ID COMMA partsparts : IDparts : empty'
+    
+_lr_action_items = {'RSQUARE':([27,45,46,47,48,49,51,52,54,62,63,64,66,73,74,77,],[-7,-7,65,-46,-47,67,68,-14,-13,72,-11,-12,-7,-7,-45,-10,]),'ANYINDEX':([4,30,33,34,35,36,37,38,39,41,70,71,],[13,13,-29,-30,13,-27,-28,-25,-26,13,13,13,]),'GT':([15,16,20,67,68,],[-40,-41,33,-24,-23,]),'LTE':([15,16,20,67,68,],[-40,-41,37,-24,-23,]),'OPTION':([0,1,3,5,6,7,11,21,26,28,40,42,44,65,69,72,],[2,-4,-5,2,-3,-2,-6,-1,-42,-43,-17,-16,-8,-44,-34,-9,]),'RCURLY':([4,14,15,16,17,19,30,41,50,52,53,54,55,56,57,58,59,60,61,67,68,70,75,76,],[-7,-20,-40,-41,31,-21,-7,-7,-19,-14,-22,-13,-31,-32,-33,69,-36,-37,-39,-24,-23,-7,-35,-38,]),'BECOMES':([8,31,],[22,-18,]),'GTE':([15,16,20,67,68,],[-40,-41,34,-24,-23,]),'NUMBER':([12,23,29,32,33,34,35,36,37,38,39,45,71,73,],[26,42,49,51,-29,-30,54,-27,-28,-25,-26,54,54,54,]),'ID':([0,1,3,4,5,6,7,11,21,24,26,27,28,30,33,34,35,36,37,38,39,40,41,42,44,65,66,69,70,71,72,],[10,-4,-5,18,10,-3,-2,-6,-1,43,-42,47,-43,18,-29,-30,18,-27,-28,-25,-26,-17,18,-16,-8,-44,47,-34,18,18,-9,]),'LCURLY':([0,1,3,5,6,7,11,21,22,26,28,40,42,44,65,69,72,],[4,-4,-5,4,-3,-2,-6,-1,41,-42,-43,-17,-16,-8,-44,-34,-9,]),'LT':([15,16,20,67,68,],[-40,-41,36,-24,-23,]),'PAUSE':([33,34,35,36,37,38,39,45,71,73,],[-29,-30,52,-27,-28,-25,-26,52,52,52,]),'COMMA':([14,15,16,47,52,53,54,55,56,57,59,61,63,67,68,76,],[30,-40,-41,66,-14,-22,-13,-31,-32,-33,70,-39,73,-24,-23,-38,]),'LSQUARE':([12,13,18,25,],[27,29,32,45,]),'NEQ':([15,16,20,67,68,],[-40,-41,39,-24,-23,]),'EQ':([15,16,20,67,68,],[-40,-41,38,-24,-23,]),'ASSIGN':([2,9,10,15,16,43,61,67,68,],[12,23,25,-40,-41,-15,71,-24,-23,]),'DOT':([10,],[24,]),'$end':([1,3,5,6,7,11,21,26,28,40,42,44,65,69,72,],[-4,-5,0,-3,-2,-6,-1,-42,-43,-17,-16,-8,-44,-34,-9,]),}
+
+_lr_action = {}
+for _k, _v in _lr_action_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+      if not _x in _lr_action:  _lr_action[_x] = {}
+      _lr_action[_x][_k] = _y
+del _lr_action_items
+
+_lr_goto_items = {'program':([0,],[5,]),'partassign':([0,5,],[6,6,]),'partlist':([12,],[28,]),'subject':([4,30,41,70,],[20,20,61,61,]),'propassign':([0,5,],[1,1,]),'note':([35,45,71,73,],[55,63,55,63,]),'parts':([27,66,],[46,74,]),'notelist':([25,],[44,]),'statement':([0,5,],[7,21,]),'indexed':([4,30,35,41,70,71,],[15,15,56,15,15,56,]),'confassign':([0,5,],[11,11,]),'conditions':([4,30,],[17,50,]),'empty':([4,27,30,41,45,66,70,73,],[19,48,19,60,64,48,60,64,]),'rhs':([22,],[40,]),'object':([35,71,],[53,76,]),'condition':([4,30,],[14,14,]),'anyindexed':([4,30,35,41,70,71,],[16,16,57,16,16,57,]),'modifiers':([41,70,],[58,75,]),'comparator':([20,],[35,]),'notes':([45,73,],[62,77,]),'rule':([0,5,],[3,3,]),'modifier':([41,70,],[59,59,]),'lhs':([0,5,],[8,8,]),'property':([0,5,],[9,9,]),}
+
+_lr_goto = {}
+for _k, _v in _lr_goto_items.items():
+   for _x, _y in zip(_v[0], _v[1]):
+       if not _x in _lr_goto: _lr_goto[_x] = {}
+       _lr_goto[_x][_k] = _y
+del _lr_goto_items
+_lr_productions = [
+  ("S' -> program","S'",1,None,None,None),
+  ('program -> program statement','program',2,'p_program','parser.py',112),
+  ('program -> statement','program',1,'p_program','parser.py',113),
+  ('statement -> partassign','statement',1,'p_statement','parser.py',116),
+  ('statement -> propassign','statement',1,'p_statement','parser.py',117),
+  ('statement -> rule','statement',1,'p_statement','parser.py',118),
+  ('statement -> confassign','statement',1,'p_statement','parser.py',119),
+  ('empty -> <empty>','empty',0,'p_empty','parser.py',122),
+  ('partassign -> ID ASSIGN notelist','partassign',3,'p_partassign','parser.py',126),
+  ('notelist -> LSQUARE notes RSQUARE','notelist',3,'p_notelist','parser.py',134),
+  ('notes -> note COMMA notes','notes',3,'p_notes_list','parser.py',140),
+  ('notes -> note','notes',1,'p_notes_single','parser.py',144),
+  ('notes -> empty','notes',1,'p_notes_empty_error','parser.py',148),
+  ('note -> NUMBER','note',1,'p_note_number','parser.py',152),
+  ('note -> PAUSE','note',1,'p_note_pause','parser.py',156),
+  ('property -> ID DOT ID','property',3,'p_property','parser.py',160),
+  ('propassign -> property ASSIGN NUMBER','propassign',3,'p_propassign_number','parser.py',166),
+  ('rule -> lhs BECOMES rhs','rule',3,'p_rule','parser.py',176),
+  ('lhs -> LCURLY conditions RCURLY','lhs',3,'p_lhs','parser.py',180),
+  ('conditions -> condition COMMA conditions','conditions',3,'p_conditions_list','parser.py',184),
+  ('conditions -> condition','conditions',1,'p_conditions_single','parser.py',188),
+  ('conditions -> empty','conditions',1,'p_conditions_empty','parser.py',192),
+  ('condition -> subject comparator object','condition',3,'p_condition','parser.py',196),
+  ('indexed -> ID LSQUARE NUMBER RSQUARE','indexed',4,'p_indexed','parser.py',200),
+  ('anyindexed -> ANYINDEX LSQUARE NUMBER RSQUARE','anyindexed',4,'p_anyindexed','parser.py',206),
+  ('comparator -> EQ','comparator',1,'p_comparator','parser.py',210),
+  ('comparator -> NEQ','comparator',1,'p_comparator','parser.py',211),
+  ('comparator -> LT','comparator',1,'p_comparator','parser.py',212),
+  ('comparator -> LTE','comparator',1,'p_comparator','parser.py',213),
+  ('comparator -> GT','comparator',1,'p_comparator','parser.py',214),
+  ('comparator -> GTE','comparator',1,'p_comparator','parser.py',215),
+  ('object -> note','object',1,'p_object','parser.py',219),
+  ('object -> indexed','object',1,'p_object','parser.py',220),
+  ('object -> anyindexed','object',1,'p_object','parser.py',221),
+  ('rhs -> LCURLY modifiers RCURLY','rhs',3,'p_rhs','parser.py',225),
+  ('modifiers -> modifier COMMA modifiers','modifiers',3,'p_modifiers_list','parser.py',229),
+  ('modifiers -> modifier','modifiers',1,'p_modifiers_single','parser.py',233),
+  ('modifiers -> empty','modifiers',1,'p_modifiers_empty','parser.py',237),
+  ('modifier -> subject ASSIGN object','modifier',3,'p_modifier_assign','parser.py',241),
+  ('modifier -> subject','modifier',1,'p_modifier_touch','parser.py',245),
+  ('subject -> indexed','subject',1,'p_subject','parser.py',250),
+  ('subject -> anyindexed','subject',1,'p_subject','parser.py',251),
+  ('confassign -> OPTION ASSIGN NUMBER','confassign',3,'p_confassign','parser.py',255),
+  ('confassign -> OPTION ASSIGN partlist','confassign',3,'p_confassign','parser.py',256),
+  ('partlist -> LSQUARE parts RSQUARE','partlist',3,'p_partlist','parser.py',263),
+  ('parts -> ID COMMA parts','parts',3,'p_parts_list','parser.py',269),
+  ('parts -> ID','parts',1,'p_parts_single','parser.py',273),
+  ('parts -> empty','parts',1,'p_parts_empty_error','parser.py',277),
+]
@@ -0,0 +1,128 @@
+# Celltone - Generative music composition using cellular automata
+# Copyright (C) 2012   andreas@jansson.me.uk
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''
+NumPy backend for the engine. The conditions of a rule are
+evaluated for all beats of an iteration at once, and only the
+beats that match are then committed one by one, in order, so
+that the altered flags work exactly like in the plain engine.
+'''
+
+from model import *
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if numpy:
+    ufuncs = {
+        CompEQ: numpy.equal,
+        CompNEQ: numpy.not_equal,
+        CompLT: numpy.less,
+        CompLTE: numpy.less_equal,
+        CompGT: numpy.greater,
+        CompGTE: numpy.greater_equal,
+        }
+
+class VectorEngine(Engine):
+
+    def __init__(self, parts, rules, part_order, config = None, **options):
+        if numpy is None:
+            raise Exception('The numpy backend requires numpy')
+        self.vector_rules = None
+        self.state = None
+        Engine.__init__(self, parts, rules, part_order, config, **options)
+
+    def compile_rules(self, swapped = None):
+        Engine.compile_rules(self, swapped)
+        # vector rules follow the compiled rules they were made
+        # from, so they are reused whenever those are
+        previous = self.vector_rules or {}
+        self.vector_rules = {}
+        for compiled in self.compiled_rules:
+            vector_rule = previous.get(compiled)
+            if vector_rule is None:
+                vector_rule = VectorRule(compiled)
+            self.vector_rules[compiled] = vector_rule
+
+    def apply_rules(self):
+        # the arrays are only made if some rule has to be
+        # evaluated for every beat
+        self.state = None
+        Engine.apply_rules(self)
+
+    def match_all(self, compiled):
+        candidates = self.candidate_beats(compiled)
+        if candidates is not None:
+            return [i for i in candidates if compiled.matches(i)], len(candidates)
+        if self.state is None:
+            self.state = self.vector_state()
+        arrays, beats, gathered = self.state
+        return (self.vector_rules[compiled].candidates(arrays, beats, gathered),
+                len(beats))
+
+    def vector_state(self):
+        # the note buffers are used as they are, pauses being the
+        # smallest integer, which orders them like the comparators
+        arrays = {}
+        for part in self.parts.values():
+            arrays[part.name] = numpy.frombuffer(part.read_buffer, dtype = numpy.int16)
+        beats = numpy.arange(self.iteration_length)
+        return arrays, beats, {}
+
+class VectorRule(object):
+    '''
+    The simplified conditions of a compiled rule, as array
+    operations over every beat of an iteration.
+    '''
+
+    def __init__(self, compiled):
+        self.conditions = []
+        for subject, comparator, object in compiled.resolved_conditions:
+            self.conditions.append((subject, ufuncs[comparator.__class__], object))
+
+    def candidates(self, arrays, beats, gathered):
+        '''
+        Returns the beats where all conditions hold. gathered
+        caches the notes read at each (part, offset), since rules
+        tend to read the same positions over and over.
+        '''
+        mask = None
+        for subject, ufunc, object in self.conditions:
+            subject_notes = gather(subject, arrays, beats, gathered)
+            if isinstance(object, tuple):
+                object_notes = gather(object, arrays, beats, gathered)
+            else:
+                object_notes = object
+            matches = ufunc(subject_notes, object_notes)
+            if mask is None:
+                mask = matches
+            else:
+                mask &= matches
+            if not mask.any():
+                return []
+        if mask is None:
+            return range(len(beats))
+        return numpy.flatnonzero(mask).tolist()
+
+def gather(indexed, arrays, beats, gathered):
+    part, offset = indexed
+    key = (part.name, offset)
+    if key not in gathered:
+        array = arrays[part.name]
+        gathered[key] = array[(part.pointer + offset + beats) % len(array)]
+    return gathered[key]
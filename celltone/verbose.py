@@ -18,7 +18,6 @@
 
 import os
 import textwrap
-from model import Clause
 
 DEFAULT_WIDTH = 80
 SPACES = 5
@@ -35,17 +34,57 @@ class Verbose(object):
         if self.verbosity < 1:
             return
 
-        for name in sorted(parts.keys()):
-            print(PartFormatter(parts[name], iteration_length))
-        print('')
+        print(self.format_parts(parts, iteration_length))
 
-    def print_log(self, items):
+    def print_log(self, items, evicted = 0):
         find_width()
         if self.verbosity < 2:
             return
 
+        print(self.format_log(items, evicted))
+
+    def format_parts(self, parts, iteration_length):
+        lines = [str(PartFormatter(parts[name], iteration_length))
+                 for name in sorted(parts.keys())]
+        return '\n'.join(lines + [''])
+
+    def format_log(self, items, evicted = 0):
+        lines = []
+        if evicted:
+            lines.append('(%d earlier rule applications not shown)' % evicted)
         for item in items:
-            print(RuleFormatter(item, self.verbosity >= 3))
+            lines.append(str(RuleFormatter(item, self.verbosity >= 3)))
+        return '\n'.join(lines + [''])
+
+    def format_iteration(self, parts, iteration_length, items, evicted = 0):
+        '''
+        What print_log() and print_parts() would print, as a
+        string, for output from another process.
+        '''
+        find_width()
+        text = ''
+        if self.verbosity >= 2:
+            text += self.format_log(items, evicted) + '\n'
+        if self.verbosity >= 1:
+            text += self.format_parts(parts, iteration_length) + '\n'
+        return text
+
+    def print_cycle(self, start, period):
+        if self.verbosity < 1:
+            return
+
+        if period == 1:
+            print('Fixed point reached at iteration %d' % start)
+        else:
+            print('Cycle of %d iterations, starting at iteration %d' % (period, start))
+        print('')
+
+    def print_reload(self, changes, seconds):
+        if self.verbosity < 1:
+            return
+
+        print('Reloaded in %.1f ms: %s' % (seconds * 1000,
+                                           ', '.join(changes) or 'no changes'))
         print('')
 
 class PartFormatter(object):
@@ -93,59 +132,53 @@ class RuleFormatter(object):
         self.lines += wrap(str(rule))
         
     def format_clauses(self):
-        self.format_list(self.item.rule.lhs, self.item.beat_before)
+        self.format_list(self.item.reads, [])
 
     def format_modifiers(self):
-        self.format_list(self.item.rule.rhs, self.item.beat_after)
-
-    def format_list(self, clauses, beat):
-        pivot = self.item.pivot
+        positions = [(part, index) for part, index, old, new in self.item.diffs]
+        self.format_list(positions, self.item.diffs)
+
+    def format_list(self, positions, diffs):
+        '''
+        Parts are printed as they were at the start of the
+        iteration, which is what the rule was matched against,
+        with diffs applied on top.
+        '''
         participants = {}
-        for c in clauses:
-            clause = Clause(c.subject, c.object, beat, pivot)
-            name = clause.subject_part.name
-            # beat is a copy, so we can do what we want with it
-            indexed = beat[name]
-            part = indexed.part
-            if name not in participants:
-                participants[name] = part
-                part.involved_indices = []
-            index = (clause.real_subject_index) % len(part.notes)
-            part.involved_indices.append(index)
-            if clause.object_indexed:
-                index = (clause.real_object_index) % len(part.notes)
-                part.involved_indices.append(index)
+        for part, index in positions:
+            if part.name not in participants:
+                participants[part.name] = (part, set())
+            participants[part.name][1].add(index)
 
         for i, name in enumerate(sorted(participants.keys())):
-            part = participants[name]
-            # unique, sorted
-            involved_indices = list(set(part.involved_indices))
-            involved_indices.sort()
-            self.format_part(part, involved_indices)
+            part, involved_indices = participants[name]
+            notes = list(part.notes_copy)
+            for diff_part, index, old, new in diffs:
+                if diff_part is part:
+                    notes[index] = new
+            self.format_part(name, notes, sorted(involved_indices))
             if i < len(participants) - 1:
-                print('')
+                self.lines += ['']
 
-    def format_part(self, part, involved_indices):
-        pos = 0
-        init = '%s = [' % part.name
-        pos = len(init)
+    def format_part(self, name, notes, involved_indices):
+        init = '%s = [' % name
         spaces = ' ' * SPACES
         offset = 0
-        while offset < len(part.notes):
-            lines, offset = self.get_marked_part_lines(part, involved_indices,
+        while offset < len(notes):
+            lines, offset = self.get_marked_part_lines(notes, involved_indices,
                                                        offset, init)
             self.lines += lines
             if init != spaces:
                 init = spaces
 
-    def get_marked_part_lines(self, part, involved_indices, offset, init):
+    def get_marked_part_lines(self, notes, involved_indices, offset, init):
         part_line = init
         mark_line = ' ' * len(init)
-        for i, note in enumerate(part.notes[offset:], offset):
+        for i, note in enumerate(notes[offset:], offset):
             n = len(str(note))
             part_line += str(note)
 
-            if i < len(part.notes) - 1:
+            if i < len(notes) - 1:
                 part_line += ',' # space inserted later, if we don't break line
             else:
                 part_line += ']'
@@ -154,15 +187,15 @@ class RuleFormatter(object):
                 mark_line += '^'
             mark_line += ' ' * (len(part_line) - len(mark_line))
 
-            if i < len(part.notes) - 2:
-                next_len = len(part_line) + len(str(part.notes[i + 1]))
-                if i + 1 < len(part.notes) - 1:
+            if i < len(notes) - 2:
+                next_len = len(part_line) + len(str(notes[i + 1]))
+                if i + 1 < len(notes) - 1:
                     next_len += 1 # for the space that will get added
                 next_len += 1 # for , or ]
                 if next_len > width:
                     break
 
-            if i < len(part.notes) - 1:
+            if i < len(notes) - 1:
                 part_line += ' '
                 mark_line += ' '
 
@@ -0,0 +1,136 @@
+# Celltone - Generative music composition using cellular automata
+# Copyright (C) 2012   andreas@jansson.me.uk
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''
+Watches the source file during playback, and parses new versions
+as soon as they are saved, so that they are ready to be applied by
+the time the main loop gets to them.
+'''
+
+import os
+import threading
+import time
+import celltone
+import parser
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+class Watcher(threading.Thread):
+    '''
+    Uses inotify if pyinotify is installed, and otherwise polls
+    the file every poll_interval seconds. With inotify, the
+    directory is watched rather than the file, since many editors
+    save by renaming a new file over the old one.
+    '''
+
+    poll_interval = 0.05
+
+    def __init__(self, filename, code):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.filename = os.path.abspath(filename)
+        self.code = code
+        self.parser = parser.Parser()
+        self.lock = threading.Lock()
+        self.pending = None
+        self.closed = threading.Event()
+        self.last_stat = self.stat()
+
+    def take(self):
+        '''
+        Returns the latest (code, program, time of change) that
+        has not been taken yet, or None. program is what
+        Parser.parse() returns.
+        '''
+        with self.lock:
+            pending = self.pending
+            self.pending = None
+        return pending
+
+    def close(self, timeout = 1):
+        '''
+        Stops watching, and waits for the thread to end, so that it
+        is not left running while the interpreter shuts down.
+        '''
+        self.closed.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        # the parser remembers the parts it has seen, which makes
+        # parsing the next version faster
+        self.parser.parse(self.code)
+        if self.closed.is_set():
+            return
+        if pyinotify:
+            self.watch()
+        else:
+            self.poll()
+
+    def watch(self):
+        watch_manager = pyinotify.WatchManager()
+        watch_manager.add_watch(os.path.dirname(self.filename),
+                                pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO,
+                                proc_fun = self.handle_event)
+        notifier = pyinotify.Notifier(watch_manager,
+                                      timeout = int(self.poll_interval * 1000))
+        while not self.closed.is_set():
+            if notifier.check_events():
+                notifier.read_events()
+                notifier.process_events()
+        notifier.stop()
+
+    def handle_event(self, event):
+        if event.pathname == self.filename:
+            self.reload()
+
+    def poll(self):
+        while not self.closed.wait(self.poll_interval):
+            stat = self.stat()
+            if stat != self.last_stat:
+                self.last_stat = stat
+                self.reload()
+
+    def stat(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def reload(self):
+        changed = time.time()
+        try:
+            with open(self.filename) as f:
+                code = f.read()
+        except IOError:
+            return
+        if code == self.code:
+            return
+        if not code:
+            celltone.warning('File is empty')
+            return
+        try:
+            program = self.parser.parse(code)
+        except parser.ParseError as e:
+            celltone.warning(str(e))
+            return
+        self.code = code
+        with self.lock:
+            self.pending = (code, program, changed)
@@ -0,0 +1,155 @@
+# Celltone - Generative music composition using cellular automata
+# Copyright (C) 2012   andreas@jansson.me.uk
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''
+Runs the engine in a separate process, so that rule evaluation
+does not compete with playback for the interpreter.
+'''
+
+from collections import deque
+import multiprocessing
+try:
+    from Queue import Full
+except ImportError:
+    from queue import Full
+import model
+import parser
+import celltone
+from cellmidi import MidiNote
+
+class EngineProcess(object):
+    '''
+    Computes up to lookahead iterations ahead of playback. Each
+    iteration is sent over as a compact grid of (pitch, channel,
+    velocity) tuples per step.
+
+    Dynamic updates are rebased on the iteration that is to be
+    played next: the worker goes back to the state it had at that
+    iteration, applies the update, and everything computed after
+    that point is thrown away.
+    '''
+
+    def __init__(self, code, lookahead, backend = 'python', verbosity = 0):
+        # commands go over a pipe rather than a queue, so that they
+        # reach the worker as soon as they are sent. A queue hands
+        # them to a feeder thread, and in the meantime the worker
+        # could get so far ahead that the iteration to rebase on is
+        # no longer in its history.
+        self.commands, worker_commands = multiprocessing.Pipe()
+        self.results = multiprocessing.Queue(maxsize = lookahead)
+        self.generation = 0
+        self.next_iteration = 0
+        self.process = multiprocessing.Process(
+            target = run_worker,
+            args = (code, lookahead, backend, verbosity, worker_commands, self.results))
+        self.process.daemon = True
+        self.process.start()
+
+    def next(self):
+        '''
+        Returns the midi notes of the next iteration, along with
+        verbose output for it, if any.
+        '''
+        while True:
+            generation, iteration, grid, text = self.results.get()
+            if generation == self.generation:
+                break
+        self.next_iteration = iteration + 1
+        midi_notes = [[MidiNote(*note) for note in step] for step in grid]
+        return midi_notes, text
+
+    def update_code(self, code):
+        self.generation += 1
+        self.commands.send(('update', self.generation, self.next_iteration, code))
+
+    def close(self):
+        self.commands.send(('exit', ))
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+def make_engine(code, backend = 'python'):
+    parts, rules, part_order, config = parser.Parser().parse(code)
+    if backend == 'numpy':
+        from vectorized import VectorEngine as Engine
+    else:
+        Engine = model.Engine
+    return Engine(parts, rules, part_order, config)
+
+def run_worker(code, lookahead, backend, verbosity, commands, results):
+    engine = make_engine(code, backend)
+    engine.logger.enabled = verbosity >= 2
+    if verbosity:
+        from verbose import Verbose
+        verbose = Verbose(verbosity)
+    history = deque(maxlen = lookahead + 2)
+    generation = 0
+
+    while True:
+        history.append((engine.iteration, engine.get_state()))
+        grid = [[(note.pitch, note.channel, note.velocity) for note in step]
+                for step in engine.get_midi_notes()]
+        text = None
+        if verbosity:
+            text = verbose.format_iteration(engine.parts, engine.iteration_length,
+                                            engine.logger.items, engine.logger.evicted)
+        result = (generation, engine.iteration, grid, text)
+
+        updated = False
+        while True:
+            command = None
+            if commands.poll():
+                command = commands.recv()
+            if command and command[0] == 'exit':
+                return
+            if command and command[0] == 'update':
+                generation = command[1]
+                # the main process only sends code that it could parse
+                program = parser.Parser().parse(command[3])
+                if not rebase(engine, history, command[2]):
+                    celltone.warning('Iteration %d is no longer in the lookahead history, '
+                                     'updating from iteration %d instead' %
+                                     (command[2], engine.iteration))
+                engine.update(*program)
+                engine.logger.clear()
+                updated = True
+                break
+            try:
+                results.put(result, timeout = 0.05)
+                break
+            except Full:
+                pass
+
+        if not updated:
+            engine.logger.clear()
+            engine.iterate()
+
+def rebase(engine, history, iteration):
+    '''
+    Restores the state the engine had at iteration, if it is
+    still in history. Returns False if it is not.
+    '''
+    while history:
+        past_iteration, state = history.pop()
+        if past_iteration == iteration:
+            engine.set_state(state)
+            engine.iteration = iteration
+            # the cycle, if any, was found from a later iteration,
+            # so it has to be found again from here
+            engine.reset_cycle()
+            return True
+    return False
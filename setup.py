@@ -15,11 +15,7 @@ setup(
             ]
         },
     #install_requires = ['ply>=3.0', 'pyrex', 'pyPortMidi>=0.0.3', 'argparse>=1.0'],
-    install_requires = ['midi>=0.2.2', 'ply>=3.0', 'argparse>=1.0'],
-
-    dependency_links = [
-        'https://github.com/vishnubob/python-midi/tarball/master',
-        ],
+    install_requires = ['ply>=3.10', 'argparse>=1.0'],
 
     author = 'Andreas Jansson',
     author_email = 'andreas@jansson.me.uk',
@@ -0,0 +1,42 @@
+import sys
+sys.path.append('..')
+from celltone.model import *
+
+def make_engine(engine_class, **options):
+    '''
+    A small program that exercises indexed and any-indexed
+    conditions, for comparing other engines with Engine.
+    '''
+    _ = PAUSE # for readability
+
+    a = Part('a', [0, _, 1, _, 0, _, 3, _])
+    b = Part('b', [0, 3, _])
+    c = Part('c', [_, 2, 2, _, 5])
+    parts = {'a': a, 'b': b, 'c': c}
+
+    rule1 = Rule([Condition(Indexed(a, 0), CompEQ(), Indexed(b, 0)),
+                  Condition(Indexed(a, 1), CompEQ(), _)],
+                 [Modifier(Indexed(a, 0), Indexed(a, 0))])
+    rule2 = Rule([Condition(Indexed(a, -1), CompNEQ(), _),
+                  Condition(Indexed(a, 0), CompEQ(), _)],
+                 [Modifier(Indexed(a, -1), _),
+                  Modifier(Indexed(a, 0), Indexed(a, -1))])
+    rule3 = Rule([Condition(AnyIndexed(0, 0), CompGT(), AnyIndexed(1, 0)),
+                  Condition(AnyIndexed(-1, 1), CompLTE(), 2)],
+                 [Modifier(AnyIndexed(1, 0), AnyIndexed(0, 0)),
+                  Modifier(AnyIndexed(0, 0), _)])
+
+    return engine_class(parts, [rule1, rule2, rule3], [a, b, c], **options)
+
+def assert_same_as_engine(test, other, iterations = 20):
+    '''
+    Iterates other alongside an Engine running the same program,
+    asserting that the parts stay the same.
+    '''
+    engine = make_engine(Engine)
+    for i in range(iterations):
+        engine.iterate()
+        other.iterate()
+        for name in engine.parts:
+            test.assertEquals(engine.parts[name].notes, other.parts[name].notes)
+            test.assertEquals(engine.parts[name].pointer, other.parts[name].pointer)
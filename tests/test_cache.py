@@ -0,0 +1,73 @@
+import sys
+import sys, os
+sys.path.append('..')
+from celltone.cache import ProgramCache
+from celltone import cache as cache_module
+from celltone.parser import Parser
+import shutil
+import tempfile
+import unittest
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_put(self):
+        code = 'a = [1, 2, _]\n{a[0] == 1} => {a[1] = 3}\n'
+        cache = ProgramCache(self.directory)
+        self.assertEquals(None, cache.get(code))
+
+        cache.put(code, Parser().parse(code))
+        parts, rules, part_order, config = cache.get(code)
+        self.assertEquals([1, 2, '_'], parts['a'].notes)
+        self.assertEquals(bytearray(3), parts['a'].altered)
+        self.assertTrue(rules[0].lhs[0].subject.part is parts['a'])
+        self.assertEquals(None, cache.get(code + '\n'))
+
+    def test_format(self):
+        code = 'a = [1, 2]\n'
+        cache = ProgramCache(self.directory)
+        cache.put(code, Parser().parse(code))
+        cache_format = cache_module.CACHE_FORMAT
+        cache_module.CACHE_FORMAT += 1
+        try:
+            self.assertEquals(None, cache.get(code))
+        finally:
+            cache_module.CACHE_FORMAT = cache_format
+        self.assertNotEquals(None, cache.get(code))
+
+    def test_evict(self):
+        codes = ['a = [%d]\n' % i for i in range(3)]
+        cache = ProgramCache(self.directory)
+        cache.put(codes[0], Parser().parse(codes[0]))
+        size = os.path.getsize(cache.filename(codes[0]))
+
+        cache.max_size = size * 2
+        for code in codes[1:]:
+            os.utime(cache.filename(codes[0]), (0, 0))
+            cache.put(code, Parser().parse(code))
+        self.assertEquals(None, cache.get(codes[0]))
+        self.assertNotEquals(None, cache.get(codes[1]))
+        self.assertNotEquals(None, cache.get(codes[2]))
+
+    def test_unwritable(self):
+        code = 'a = [1, 2]\n'
+        # a file where the cache directory should be
+        filename = os.path.join(self.directory, 'programs')
+        open(filename, 'w').close()
+
+        cache = ProgramCache(filename)
+        self.assertFalse(cache.put(code, Parser().parse(code)))
+        self.assertEquals(None, cache.get(code))
+        self.assertEquals(['programs'], os.listdir(self.directory))
+
+        cache = ProgramCache(os.path.join(filename, 'programs'))
+        self.assertFalse(cache.put(code, Parser().parse(code)))
+        self.assertEquals(None, cache.get(code))
+
+if __name__ == '__main__':
+    unittest.main()
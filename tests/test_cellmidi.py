@@ -0,0 +1,109 @@
+import sys
+import sys, os 
+sys.path.append('..')
+from celltone.cellmidi import *
+import tempfile
+import struct
+import unittest
+
+class TestCellmidi(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix = '.mid')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_varlen(self):
+        self.assertEquals(bytearray([0]), varlen(0))
+        self.assertEquals(bytearray([0x7f]), varlen(0x7f))
+        self.assertEquals(bytearray([0x81, 0x00]), varlen(0x80))
+        self.assertEquals(bytearray([0xff, 0x7f]), varlen(0x3fff))
+        self.assertEquals(bytearray([0x81, 0x80, 0x00]), varlen(0x4000))
+
+    def test_writer(self):
+        writer = Writer(self.filename, 120, 16)
+        writer.render([[MidiNote(60, 0, 100), MidiNote(64, 0, 90)],
+                       [],
+                       [MidiNote(67, 1, 80)]])
+        writer.write()
+
+        with open(self.filename, 'rb') as f:
+            data = bytearray(f.read())
+
+        self.assertEquals(b'MThd', bytes(data[:4]))
+        self.assertEquals((6, 0, 1, 48), struct.unpack('>IHHH', bytes(data[4:14])))
+        self.assertEquals(b'MTrk', bytes(data[14:18]))
+        length, = struct.unpack('>I', bytes(data[18:22]))
+        self.assertEquals(len(data) - 22, length)
+
+        track = data[22:]
+        expected = bytearray([
+                0x00, 0xff, 0x51, 0x03, 0x07, 0xa1, 0x20, # tempo 120
+                0x00, 0x90, 60, 100,
+                0x00, 64, 90,                             # running status
+                0x0c, 60, 0,
+                0x00, 64, 0,
+                0x0c, 0x91, 67, 80,
+                0x0c, 67, 0,
+                0x00, 0xff, 0x2f, 0x00,
+                ])
+        self.assertEquals(expected, track)
+
+    def test_scheduler_drift(self):
+        handler = FakeClockHandler(120, 16)
+        midi_notes = [[MidiNote(60 + i, 0, 100)] for i in range(4)]
+        handler.play(midi_notes)
+        handler.play(midi_notes)
+        handler.join()
+
+        noteons = [(pitch, t) for event, pitch, t in handler.events if event == 'on']
+        self.assertEquals([60, 61, 62, 63] * 2, [pitch for pitch, t in noteons])
+        for i, (pitch, t) in enumerate(noteons):
+            self.assertAlmostEqual(i * 0.125, t, delta = 0.0015)
+        self.assertEquals(1.0, handler.time)
+        self.assertEquals([], handler.stop())
+
+    def test_scheduler_tempo(self):
+        handler = FakeClockHandler(120, 16)
+        midi_notes = [[MidiNote(60 + i, 0, 100)] for i in range(4)]
+        handler.play(midi_notes)
+        # takes effect after the steps that are already queued
+        handler.set_tempo(60)
+        handler.play(midi_notes)
+        handler.join()
+        self.assertEquals(60, handler.bpm)
+
+        noteons = [t for event, pitch, t in handler.events if event == 'on']
+        expected = [0, 0.125, 0.25, 0.375, 0.5, 0.75, 1.0, 1.25]
+        for t, expected_t in zip(noteons, expected):
+            self.assertAlmostEqual(expected_t, t, delta = 0.0015)
+        self.assertEquals(1.5, handler.time)
+
+class FakeClockHandler(Handler):
+    '''
+    Runs on a fake clock, where every wait overshoots by a
+    millisecond.
+    '''
+
+    def __init__(self, bpm, subdivision):
+        Handler.__init__(self, bpm, subdivision)
+        self.clock = 0.0
+        self.events = []
+
+    def now(self):
+        return self.clock
+
+    def wait_until(self, deadline):
+        if deadline > self.clock:
+            self.clock = deadline + 0.001
+
+    def noteon(self, note):
+        self.events.append(('on', note.pitch, self.clock))
+
+    def noteoff(self, note):
+        self.events.append(('off', note.pitch, self.clock))
+
+if __name__ == '__main__':
+    unittest.main()
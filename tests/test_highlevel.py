@@ -4,6 +4,10 @@ sys.path.append('..')
 from celltone.celltone import Celltone
 import celltone.model
 import celltone.parser
+from celltone.watcher import Watcher
+import tempfile
+import threading
+import time
 import unittest
 
 class TestHighlevel(unittest.TestCase):
@@ -26,7 +30,7 @@ c.octava = 0
 {<0>[0] == <1>[0], <0>[0] == 1} => {<0>[0] = _, <2>[0] = 1}
 '''
 
-        ct = Celltone(code)
+        ct = Celltone(code, use_cache = False)
         midi_notes = ct.engine.get_midi_notes()
         m = midi_map(midi_notes)
         self.assertEquals([{0: 1, 2: 1}, {}, {}, {0: 1}], m)
@@ -40,13 +44,192 @@ c.octava = 0
         midi_notes = ct.engine.get_midi_notes()
         m = midi_map(midi_notes)
         self.assertEquals([{1: 1}, {}, {1: 1, 2: 1}, {}], m)
-    
+
+    def test_lookahead(self):
+
+        code = '''
+a = [5, 3, 1, _, 4]
+b = [_, 2]
+
+{a[-1] > a[0]} => {a[-1] = a[0], a[0] = a[-1]}
+{<0>[0] == _, <1>[0] != _} => {<0>[0] = <1>[0]}
+'''
+        updated_code = code.replace('a[-1] > a[0]', 'a[-1] < a[0]')
+
+        fd, filename = tempfile.mkstemp(suffix = '.mid')
+        os.close(fd)
+
+        ct = Celltone(code, output_file = filename, catch_sigint = False,
+                      use_cache = False)
+        expected = []
+        for i in range(8):
+            if i == 4:
+                ct.update_code(updated_code)
+            expected.append(midi_map(ct.engine.get_midi_notes()))
+            ct.engine.iterate()
+
+        ct = Celltone(code, output_file = filename, catch_sigint = False,
+                      use_cache = False, lookahead = 3)
+        try:
+            for i in range(8):
+                if i == 4:
+                    ct.update_code(updated_code)
+                midi_notes, text = ct.engine_process.next()
+                self.assertEquals(expected[i], midi_map(midi_notes))
+        finally:
+            ct.engine_process.close()
+            os.remove(filename)
+
+    def test_lookahead_cycle(self):
+
+        # repeats itself every other iteration from the start
+        code = '''
+a = [1, 2, 3]
+b = [4, _]
+<tempo> = 120
+'''
+        fd, filename = tempfile.mkstemp(suffix = '.mid')
+        os.close(fd)
+
+        ct = Celltone(code, output_file = filename, catch_sigint = False,
+                      use_cache = False)
+        expected = []
+        for i in range(12):
+            expected.append(midi_map(ct.engine.get_midi_notes()))
+            ct.engine.iterate()
+
+        ct = Celltone(code, output_file = filename, catch_sigint = False,
+                      use_cache = False, lookahead = 4)
+        try:
+            for i in range(12):
+                if i == 6:
+                    # give the worker time to get into the cycle
+                    time.sleep(0.2)
+                    ct.update_code(code.replace('120', '90'))
+                midi_notes, text = ct.engine_process.next()
+                self.assertEquals(expected[i], midi_map(midi_notes))
+        finally:
+            ct.engine_process.close()
+            os.remove(filename)
+
+    def test_sessions(self):
+
+        codes = ['a = [1, 2, 3]\n{a[0] == 1} => {a[1] = 4}\n',
+                 'b = [5, _]\nc = [6]\n<tempo> = 90\n']
+
+        def parse(code, results):
+            for i in range(50):
+                results.append(celltone.parser.Parser().parse(code))
+
+        results = [[], []]
+        threads = [threading.Thread(target = parse, args = args)
+                   for args in zip(codes, results)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for parts, rules, part_order, config in results[0]:
+            self.assertEquals(['a'], parts.keys())
+            self.assertEquals(1, len(rules))
+            self.assertEquals(120, config.get('tempo'))
+        for parts, rules, part_order, config in results[1]:
+            self.assertEquals(['b', 'c'], [part.name for part in part_order])
+            self.assertEquals(0, len(rules))
+            self.assertEquals(90, config.get('tempo'))
+
+    def test_reparse(self):
+
+        code = '''
+a = [1, 2,
+     3, _]   # comment
+b = [4]
+a.channel = 2
+{a[0] == 1}
+  =>
+{b[0] = a[1]}
+'''
+        p = celltone.parser.Parser()
+        parts, rules, part_order, config = p.parse(code)
+        parts['a'].notes[0] = 9
+
+        parts, rules, part_order, config = p.parse(code.replace('[4]', '[5]'))
+        self.assertEquals([1, 2, 3, '_'], parts['a'].notes)
+        self.assertEquals(2, parts['a'].properties['channel'])
+        self.assertEquals([5], parts['b'].notes)
+        self.assertEquals(['a', 'b'], [part.name for part in part_order])
+        self.assertEquals(['{a[0] == 1} => {b[0] = a[1]}'], map(str, rules))
+
+        try:
+            p.parse(code.replace('b = [4]', 'a = [4]'))
+            self.fail()
+        except celltone.parser.ParseError as e:
+            self.assertEquals("Error on line 4: Cannot redefine part 'a'", str(e))
+
+    def test_watcher(self):
+
+        code = 'a = [1, 2]\n'
+        fd, filename = tempfile.mkstemp(suffix = '.ct')
+        os.close(fd)
+        with open(filename, 'w') as f:
+            f.write(code)
+
+        watcher = Watcher(filename, code)
+        watcher.start()
+        try:
+            with open(filename, 'w') as f:
+                f.write('a = [1, 2]\nb = [3]\n')
+            for i in range(100):
+                pending = watcher.take()
+                if pending:
+                    break
+                time.sleep(0.05)
+        finally:
+            watcher.close()
+            os.remove(filename)
+        self.assertFalse(watcher.is_alive())
+
+        code, (parts, rules, part_order, config), changed = pending
+        self.assertEquals(['a', 'b'], [part.name for part in part_order])
+        self.assertEquals([3], parts['b'].notes)
+
+    def test_benchmark(self):
+
+        code = '''
+a = [1, 2, 3, 4]
+<tempo> = 60
+<subdiv> = 4
+{a[0] > a[1]} => {a[0] = a[1], a[1] = a[0]}
+'''
+        ct = Celltone(code, catch_sigint = False, use_cache = False, benchmark = True)
+        benchmark = ct.benchmark(20)
+        self.assertEquals(20, len(benchmark.times))
+        self.assertEquals(4.0, benchmark.iteration_duration())
+        self.assertTrue(benchmark.keeps_up())
+        # rules are not evaluated once the engine repeats itself
+        self.assertTrue(benchmark.cycle)
+        self.assertTrue(0 < benchmark.evaluations < 20 * 4)
+        self.assertEquals(ct.engine.evaluated, benchmark.evaluations)
+
+    def test_profile_thread(self):
+
+        code = 'a = [1, 2]\n{a[0] == 1} => {a[1] = 3}\n'
+        results = []
+        def start():
+            results.append(Celltone(code, catch_sigint = False, use_cache = False,
+                                    profile = True, benchmark = True))
+        thread = threading.Thread(target = start)
+        thread.start()
+        thread.join()
+        self.assertEquals(1, len(results))
+        self.assertTrue(results[0].engine.profiler.enabled)
+
 def midi_map(midi_notes):
     m = []
     for i, notes in enumerate(midi_notes):
         m.append({})
         for note in notes:
-            m[i][note.channel] = note.note
+            m[i][note.channel] = note.pitch
 
     return m
 
@@ -102,6 +102,23 @@ class TestModel(unittest.TestCase):
         self.assertTrue(cond.matches({'a': I(a, 0), 'b': I(b, 1), 'c': I(c, 1)}, c))
         self.assertFalse(cond.matches({'a': I(a, 0), 'b': I(b, 1), 'c': I(c, 2)}, c))
 
+    def test_other_part_at(self):
+        parts = [Part('p%d' % i, [i]) for i in range(2000)]
+        link_parts(parts)
+        self.assertTrue(parts[0].other_part_at(1999) is parts[1999])
+        self.assertTrue(parts[0].other_part_at(-1500) is parts[500])
+        self.assertTrue(parts[10].other_part_at(4005) is parts[15])
+        self.assertTrue(parts[0].prev_part is parts[1999])
+
+        anyindexed = AnyIndexed(-1, 2)
+        bound = anyindexed.bind(parts[0])
+        self.assertTrue(bound.part is parts[1999])
+        self.assertEquals(2, bound.index)
+        self.assertTrue(anyindexed.bind(parts[0]) is bound)
+
+        link_parts(parts[::-1])
+        self.assertTrue(anyindexed.bind(parts[0]).part is parts[1])
+
     def test_can_alter(self):
         a = Part('a', [1,2,3,4])
         a.set_note_at(-1, 5)
@@ -128,6 +145,32 @@ class TestModel(unittest.TestCase):
         modifier.alter({'a': Indexed(a, 1), 'b': Indexed(b, 2)}, None)
         self.assertEquals([5,6,8], b.notes)
 
+    def test_notes_copy(self):
+        _ = PAUSE # for readability
+
+        a = Part('a', [1, _, 3])
+        self.assertEquals(PAUSE_CODE, a.buffer[1])
+        self.assertTrue(a.buffer[1] < a.buffer[0])
+
+        a.set_note_at(0, 2)
+        a.set_note_at(1, 4)
+        self.assertEquals([2, 4, 3], a.notes)
+        self.assertEquals([1, _, 3], a.notes_copy)
+        self.assertEquals([1, 1, 0], list(a.altered))
+
+        a.create_notes_copy()
+        a.reset_altered()
+        self.assertEquals([2, 4, 3], a.notes)
+        self.assertEquals([2, 4, 3], a.notes_copy)
+        self.assertEquals([0, 0, 0], list(a.altered))
+
+        state = a.get_state()
+        a.notes[2] = _
+        self.assertEquals(None, a.changed)
+        a.set_state(state)
+        a.create_notes_copy()
+        self.assertEquals([2, 4, 3], a.notes_copy)
+
     def test_rule_apply_single(self):
         a = Part('a', [1,2,3,4])
         b = Part('b', [5,6,7])
@@ -140,6 +183,24 @@ class TestModel(unittest.TestCase):
         rule.apply({'a': Indexed(a, 2), 'b': Indexed(b, 2)}, None)
         self.assertEquals([1,2,3,8], a.notes)
 
+    def test_rule_apply_offset(self):
+        a = Part('a', [1,2,3,4])
+        b = Part('b', [5,6,7])
+        a.pointer = 2
+        b.pointer = 1
+
+        lhs = [Condition(Indexed(a, 0), CompEQ(), 4),
+               Condition(Indexed(b, 0), CompEQ(), Indexed(b, -1))]
+        rhs = [Modifier(Indexed(a, -1), Indexed(b, 0))]
+        rule = Rule(lhs, rhs)
+        rule.apply(0, None)
+        self.assertEquals([1,2,3,4], a.notes)
+        rule.apply(1, None)
+        self.assertEquals([1,2,3,4], a.notes)
+        b.notes_copy[2] = 6
+        rule.apply(1, None)
+        self.assertEquals([1,2,6,4], a.notes)
+
     def test_rule_apply_overlapping(self):
         a = Part('a', [1,1,1,1,1])
 
@@ -158,6 +219,222 @@ class TestModel(unittest.TestCase):
         rule.apply({'a': Indexed(a, 4)}, None)
         self.assertEquals([2, _, 2, _, 1], a.notes)
 
+    def test_compiled_rule(self):
+        _ = PAUSE # for readability
+
+        a = Part('a', [1, _, 3, 3])
+        b = Part('b', [3, 1, _])
+        parts = {'a': a, 'b': b}
+        link_parts([a, b])
+
+        lhs = [Condition(AnyIndexed(0, 0), CompGT(), AnyIndexed(1, -1)),
+               Condition(Indexed(a, 1), CompNEQ(), 1)]
+        rhs = [Modifier(AnyIndexed(1, 0), Indexed(a, 0))]
+        rule = Rule(lhs, rhs)
+
+        compiled = CompiledRule(rule, b, parts)
+        self.assertEquals([False, False, False, False],
+                          [compiled.matches(i) for i in range(4)])
+
+        compiled = CompiledRule(rule, a, parts)
+        self.assertEquals([True, False, True, False],
+                          [compiled.matches(i) for i in range(4)])
+
+        self.assertTrue(compiled.can_alter(0))
+        compiled.alter(0)
+        self.assertEquals([1, 1, _], b.notes)
+        self.assertFalse(compiled.can_alter(0))
+        self.assertFalse(compiled.can_alter(3))
+        self.assertTrue(compiled.can_alter(1))
+
+    def test_order_checks(self):
+        a = Part('a', [1, 2, 3, 4, 5, 6, 7, 8])
+        b = Part('b', [1, 1, 1, 1, 1, 1, 1, 2])
+        parts = {'a': a, 'b': b}
+        link_parts([a, b])
+
+        lhs = [Condition(Indexed(a, 0), CompLT(), Indexed(a, 1)),
+               Condition(Indexed(b, 0), CompNEQ(), 1)]
+        rhs = [Modifier(Indexed(a, 0), 0), Modifier(Indexed(b, 0), 0)]
+        compiled = CompiledRule(Rule(lhs, rhs), a, parts)
+        conditions = list(compiled.conditions)
+        matches = [compiled.matches(i) for i in range(8)]
+
+        compiled.order_checks(range(8))
+        # the rarely holding condition is the cheaper one as well
+        self.assertEquals(conditions[::-1], compiled.conditions)
+        self.assertEquals(matches, [compiled.matches(i) for i in range(8)])
+        self.assertFalse(compiled.alter_first)
+
+        # conditions that nearly always hold are better left until
+        # after the modifiers are found to be blocked
+        lhs = [Condition(Indexed(a, 0), CompLT(), Indexed(a, 1)),
+               Condition(Indexed(a, 0), CompNEQ(), Indexed(a, 2))]
+        compiled = CompiledRule(Rule(lhs, rhs), a, parts)
+        for i in range(6):
+            b.set_note_at(i, 0)
+        compiled.order_checks(range(8))
+        self.assertTrue(compiled.alter_checks[0][0] is b)
+        self.assertTrue(compiled.alter_first)
+
+    def test_simplify_conditions(self):
+        _ = PAUSE # for readability
+
+        a = Part('a', [1, 2, 3])
+        b = Part('b', [4, _])
+        parts = {'a': a, 'b': b}
+        part_order = [a, b]
+        link_parts(part_order)
+
+        def simplify(*lhs):
+            compiled = CompiledRule(Rule(list(lhs), []), a, parts)
+            if compiled.never_matches:
+                return None
+            # values are encoded, see encode_note()
+            return [(part.name, offset, str(comparator), decode_note(object))
+                    for (part, offset), comparator, object in compiled.resolved_conditions]
+
+        self.assertEquals([('a', 0, '!=', _)],
+                          simplify(Condition(AnyIndexed(0, 0), CompNEQ(), _),
+                                   Condition(AnyIndexed(0, 0), CompNEQ(), _),
+                                   Condition(Indexed(a, 0), CompNEQ(), _)))
+        self.assertEquals([], simplify(Condition(Indexed(a, 0), CompEQ(), AnyIndexed(0, 3))))
+        self.assertEquals([('a', 0, '==', 4)],
+                          simplify(Condition(Indexed(a, 0), CompNEQ(), _),
+                                   Condition(Indexed(a, 0), CompEQ(), 4)))
+        self.assertEquals(None, simplify(Condition(Indexed(a, 1), CompLT(), Indexed(a, 1))))
+        self.assertEquals(None, simplify(Condition(Indexed(b, 0), CompLT(), _)))
+        self.assertEquals(None, simplify(Condition(Indexed(a, 0), CompEQ(), 1),
+                                         Condition(Indexed(a, 0), CompEQ(), 2)))
+        self.assertEquals(None, simplify(Condition(Indexed(a, 0), CompEQ(), 1),
+                                         Condition(Indexed(a, 0), CompNEQ(), 1)))
+
+        rules = [Rule([Condition(Indexed(a, 0), CompGT(), Indexed(a, 1))],
+                      [Modifier(Indexed(a, 0), Indexed(a, 1))]),
+                 Rule([Condition(AnyIndexed(0, 0), CompNEQ(), _),
+                       Condition(AnyIndexed(0, 0), CompNEQ(), _)],
+                      [Modifier(AnyIndexed(1, 0), AnyIndexed(0, 0))]),
+                 Rule([Condition(AnyIndexed(0, 0), CompLT(), _)],
+                      [Modifier(AnyIndexed(0, 0), AnyIndexed(0, 0))])]
+        engine = Engine(parts, rules, part_order)
+        # once for the first rule, and for each pivot for the second
+        self.assertEquals([(rules[0], a), (rules[1], a), (rules[1], b)],
+                          [(c.rule, c.pivot) for c in engine.compiled_rules])
+        self.assertEquals(['Repeated condition <0>[0] != _ in rule %s' % rules[1],
+                           'Rule %s can never match' % rules[2]],
+                          rule_warnings(rules, part_order, parts))
+
+    def test_rule_log(self):
+        _ = PAUSE # for readability
+
+        a = Part('a', [1, 2, 3])
+        parts = {'a': a}
+        rule = Rule([Condition(Indexed(a, 0), CompEQ(), 2)],
+                    [Modifier(Indexed(a, 1), _)])
+        engine = Engine(parts, [rule], [a])
+
+        engine.iterate()
+        self.assertEquals(0, len(engine.logger.items))
+
+        a.notes = [1, 2, 3]
+        engine.logger.enabled = True
+        engine.iterate()
+        self.assertEquals(1, len(engine.logger.items))
+        item = engine.logger.items[0]
+        self.assertEquals([(a, 1)], item.reads)
+        self.assertEquals([(a, 2, 3, _)], item.diffs)
+
+    def test_profiler(self):
+        _ = PAUSE # for readability
+
+        a = Part('a', [1, 1, 1, 2])
+        rule = Rule([Condition(Indexed(a, 0), CompEQ(), 1)],
+                    [Modifier(Indexed(a, 0), 1), Modifier(Indexed(a, 1), _)])
+        engine = Engine({'a': a}, [rule], [a], detect_cycles = False)
+        engine.profiler.enabled = True
+        engine.iterate()
+
+        self.assertEquals(1, engine.profiler.iterations)
+        stats = engine.profiler.stats[str(rule)]
+        self.assertEquals(4, stats.evaluated)
+        self.assertEquals(3, stats.matched)
+        self.assertEquals(1, stats.blocked)
+        self.assertEquals([1, _, 1, _], a.notes)
+        self.assertTrue(str(rule) in engine.profiler.report())
+
+    def test_engine_incremental(self):
+
+        def make_engine(incremental):
+            a = Part('a', [1, 2, 3, 4, 5, 6])
+            b = Part('b', [1, 2, 3, 4])
+            rules = [Rule([Condition(Indexed(a, 0), CompLT(), 3)],
+                          [Modifier(Indexed(a, 1), 1)]),
+                     Rule([Condition(Indexed(b, 0), CompEQ(), 2)],
+                          [Modifier(Indexed(b, 1), 2)])]
+            engine = Engine({'a': a, 'b': b}, rules, [a, b], detect_cycles = False,
+                            incremental = incremental)
+            engine.profiler.enabled = True
+            return engine
+
+        engine = make_engine(True)
+        reference = make_engine(False)
+        for i in range(8):
+            engine.iterate()
+            reference.iterate()
+            self.assertEquals(reference.parts['a'].notes, engine.parts['a'].notes)
+            self.assertEquals(reference.parts['b'].notes, engine.parts['b'].notes)
+
+        # the pointer of a stays put, so after the first iteration
+        # the first rule is only evaluated where a has changed
+        self.assertEquals([1] * 6, engine.parts['a'].notes)
+        stats = engine.profiler.stats[str(engine.rules[0])]
+        self.assertEquals(6 + 2 + 1 + 1 + 1, stats.evaluated)
+        stats = reference.profiler.stats[str(engine.rules[0])]
+        self.assertEquals(6 * 8, stats.evaluated)
+
+    def test_engine_replace_notes(self):
+        _ = PAUSE # for readability
+
+        a = Part('a', [1, 2, 3])
+        rules = [Rule([Condition(Indexed(a, 0), CompEQ(), 2)],
+                      [Modifier(Indexed(a, 1), _)])]
+        engine = Engine({'a': a}, rules, [a], detect_cycles = False)
+        engine.iterate()
+        # the remembered matches no longer hold
+        a.notes = [2, 5, 6]
+        engine.iterate()
+        self.assertEquals([2, _, 6], a.notes)
+
+    def test_candidate_beats(self):
+        _ = PAUSE # for readability
+
+        a = Part('a', [1, 7, 7, _, 1, 1])
+        b = Part('b', [1, 2, 7, 3])
+        rule = Rule([Condition(Indexed(a, 1), CompEQ(), 7),
+                     Condition(Indexed(b, 0), CompEQ(), 1)],
+                    [Modifier(Indexed(a, 1), 1)])
+        engine = Engine({'a': a, 'b': b}, [rule], [a, b], detect_cycles = False)
+        compiled = engine.compiled_rules[0]
+
+        # 1 is at a quarter of the notes of b, and 7 at a third of
+        # those of a
+        self.assertEquals([0, 4], engine.candidate_beats(compiled))
+        b.pointer = 1
+        self.assertEquals([3], engine.candidate_beats(compiled))
+        b.pointer = 0
+
+        engine.profiler.enabled = True
+        engine.iterate()
+        self.assertEquals([1, 1, 7, _, 1, 1], a.notes)
+        engine.iterate()
+        self.assertEquals([1, 1, 7, _, 1, 1], a.notes)
+        # the index follows the change to a, after which 7 is rarer
+        self.assertEquals([1], engine.candidate_beats(compiled))
+        self.assertEquals(2 + 1, engine.profiler.stats[str(rule)].evaluated)
+
+        engine.max_candidates = 0.1
+        self.assertEquals(None, engine.candidate_beats(compiled))
+
     def test_engine_midi_notes(self):
         _ = PAUSE # for readability
         
@@ -172,7 +449,7 @@ class TestModel(unittest.TestCase):
         midi_notes = engine.get_midi_notes()
 
         def f(notes, midi_note):
-            ns = [n.note for n in midi_note]
+            ns = [n.pitch for n in midi_note]
             self.assertEquals(notes, ns)
             
         f([0, 0], midi_notes[0])
@@ -183,7 +460,41 @@ class TestModel(unittest.TestCase):
         f([], midi_notes[5])
         f([3, 0], midi_notes[6])
         f([3], midi_notes[7])
-        
+
+    def test_midi_events(self):
+        _ = PAUSE # for readability
+
+        a = Part('a', [0, _, 2])
+        events = a.midi_events(4)
+        self.assertEquals([(0, 48), (2, 50), (3, 48)],
+                          [(i, note.pitch) for i, note in events])
+        self.assertTrue(events[0][1] is events[2][1])
+        self.assertTrue(a.midi_events(4) is events)
+
+        a.pointer = 2
+        self.assertEquals([(0, 50), (1, 48)],
+                          [(i, note.pitch) for i, note in a.midi_events(2)])
+        a.set_note_at(0, 1)
+        a.set_property('transpose', 1)
+        self.assertEquals([(0, 51), (1, 50)],
+                          [(i, note.pitch) for i, note in a.midi_events(2)])
+
+    def test_midi_warnings(self):
+        a = Part('a', [0, 100])
+        b = Part('b', [1])
+        b.set_property('channel', 16)
+        c = Part('c', [2])
+        parts = {'a': a, 'b': b, 'c': c}
+        rules = [Rule([], [Modifier(Indexed(c, 0), Indexed(a, 1))]),
+                 Rule([], [Modifier(Indexed(a, 0), -50)])]
+        engine = Engine(parts, rules, [a, b, c])
+        warnings = midi_warnings(parts, engine.compiled_rules)
+        self.assertEquals(3, len(warnings))
+        self.assertTrue('-50, 100 of part a' in warnings[0])
+        self.assertTrue('channel number 16 in part b' in warnings[1])
+        self.assertTrue('100 of part c' in warnings[2])
+        self.assertEquals(None, a.get_midi_note_at(1))
+
     def test_engine_iterate_single(self):
         _ = PAUSE # for readability
         
@@ -237,5 +548,72 @@ class TestModel(unittest.TestCase):
         self.assertEquals([0, 3, _], b.notes)
 
 
+    def test_engine_cycle(self):
+        _ = PAUSE # for readability
+
+        def make_engine(detect_cycles):
+            a = Part('a', [3, 1, 2, _])
+            b = Part('b', [0, _, 1])
+            lhs = [Condition(Indexed(a, 0), CompGT(), Indexed(a, 1))]
+            rhs = [Modifier(Indexed(a, 0), Indexed(a, 1)),
+                   Modifier(Indexed(a, 1), Indexed(a, 0))]
+            return Engine({'a': a, 'b': b}, [Rule(lhs, rhs)], [a, b],
+                          detect_cycles = detect_cycles)
+
+        engine = make_engine(True)
+        reference = make_engine(False)
+        for i in range(30):
+            self.assertEquals(engine.parts['a'].notes, reference.parts['a'].notes)
+            self.assertEquals(engine.parts['b'].pointer, reference.parts['b'].pointer)
+            midi_notes = [[n.pitch for n in step] for step in engine.get_midi_notes()]
+            reference_midi_notes = [[n.pitch for n in step]
+                                    for step in reference.get_midi_notes()]
+            self.assertEquals(reference_midi_notes, midi_notes)
+            engine.iterate()
+            reference.iterate()
+
+        self.assertEquals(None, reference.cycle)
+        self.assertEquals((0, 12), engine.cycle)
+
+    def test_engine_update(self):
+        _ = PAUSE # for readability
+
+        def make_program(b_notes, b_channel = 0):
+            a = Part('a', [1, 2, 3])
+            b = Part('b', b_notes)
+            b.set_property('channel', b_channel)
+            rules = [Rule([Condition(Indexed(a, 0), CompEQ(), 1)],
+                          [Modifier(Indexed(a, 1), 9)]),
+                     Rule([Condition(AnyIndexed(0, 0), CompEQ(), 4)],
+                          [Modifier(AnyIndexed(0, 1), _)])]
+            return {'a': a, 'b': b}, rules, [a, b], Config()
+
+        engine = Engine(*make_program([4, 5]))
+        engine.iterate()
+        a = engine.parts['a']
+        compiled_rules = engine.compiled_rules
+
+        self.assertEquals([], engine.update(*make_program([4, 5])))
+        self.assertEquals(compiled_rules, engine.compiled_rules)
+
+        self.assertEquals(['part properties'], engine.update(*make_program([4, 5], 1)))
+        self.assertEquals(1, engine.parts['b'].properties['channel'])
+
+        self.assertEquals(['parts b'], engine.update(*make_program([4, 6])))
+        self.assertTrue(a is engine.parts['a'])
+        self.assertEquals([1, 9, 3], a.notes)
+        self.assertEquals([4, 6], engine.parts['b'].notes)
+        self.assertEquals(0, engine.parts['b'].pointer)
+        self.assertTrue(engine.part_order[0].next_part is engine.parts['b'])
+        # the first rule is only compiled for one pivot. only the
+        # rules that don't involve b are kept
+        self.assertEquals(3, len(engine.compiled_rules))
+        self.assertTrue(compiled_rules[0] is engine.compiled_rules[0])
+        self.assertTrue(compiled_rules[1] is engine.compiled_rules[1])
+        self.assertFalse(compiled_rules[2] is engine.compiled_rules[2])
+
+        engine.iterate()
+        self.assertEquals([4, _], engine.parts['b'].notes)
+
 if __name__ == '__main__':
     unittest.main()
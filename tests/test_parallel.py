@@ -0,0 +1,30 @@
+import sys
+import sys, os 
+sys.path.append('..')
+from celltone import parallel
+from tests.engines import make_engine, assert_same_as_engine
+import unittest
+
+class TestParallel(unittest.TestCase):
+
+    def test_same_as_engine(self):
+        parallel_engine = make_engine(parallel.ParallelEngine, jobs = 2)
+        # always use the pool, however little there is to do
+        parallel_engine.min_parallel_beats = 0
+        try:
+            assert_same_as_engine(self, parallel_engine)
+            self.assertTrue(parallel_engine.pool is not None)
+        finally:
+            parallel_engine.close()
+
+    def test_local_fallback(self):
+        # too little to do to be worth the pool
+        parallel_engine = make_engine(parallel.ParallelEngine, jobs = 2)
+        try:
+            assert_same_as_engine(self, parallel_engine)
+            self.assertTrue(parallel_engine.pool is None)
+        finally:
+            parallel_engine.close()
+
+if __name__ == '__main__':
+    unittest.main()
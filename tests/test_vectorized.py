@@ -0,0 +1,15 @@
+import sys
+import sys, os 
+sys.path.append('..')
+from celltone import vectorized
+from tests.engines import make_engine, assert_same_as_engine
+import unittest
+
+@unittest.skipIf(vectorized.numpy is None, 'numpy is not installed')
+class TestVectorized(unittest.TestCase):
+
+    def test_same_as_engine(self):
+        assert_same_as_engine(self, make_engine(vectorized.VectorEngine))
+
+if __name__ == '__main__':
+    unittest.main()